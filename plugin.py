@@ -21,7 +21,7 @@
         <param field="Mode6" label="Debug" width="75px">
             <options>
                 <option label="Extra verbose: (Framework logs 2+4+8+16+64 + MQTT dump)" value="Verbose+"/>
-                <option label="Verbose: (Framework logs 2+4+8+16+64 + MQTT dump)" value="Verbose"/>
+                <option label="Verbose: (Framework logs 2+4+8 + MQTT ring buffer)" value="Verbose"/>
                 <option label="Normal: (Framework logs 2+4+8)" value="Debug"/>
                 <option label="None" value="Normal"  default="true" />
             </options>
@@ -30,30 +30,190 @@
 </plugin>
 """
 import Domoticz
+from collections import deque
+import cProfile
 from datetime import datetime
-from itertools import count, filterfalse
+import functools
+import heapq
 import json
+import os
+import pstats
+import random
 import re
+import struct
 import time
 import traceback
 
+class PluginLog:
+    """Level-checked logging with lazy %-formatting.
+
+    In "Verbose" mode MQTT messages are kept in a ring buffer, dumped on error
+    or on demand, instead of being written to the Domoticz log one by one
+    ("Verbose+" still writes every message). State change lines are limited
+    to one per device per stateLogInterval seconds.
+    """
+    def __init__(self):
+        self.configure("Normal", 0, 0)
+
+    def configure(self, debugging, ringSize, stateLogInterval):
+        self.debugging = debugging in ("Debug", "Verbose", "Verbose+")
+        self.verbose = debugging in ("Verbose", "Verbose+")
+        self.ring = None
+        if debugging == "Verbose" and ringSize > 0:
+            self.ring = deque(maxlen=ringSize)
+        self.stateLogInterval = stateLogInterval
+        self.stateLogged = dict() # Key=Device Unit, Value=[time of last logged line, lines skipped since]
+
+    def debug(self, fmt, *args):
+        if self.debugging:
+            Domoticz.Debug(fmt % args if args else fmt)
+
+    def error(self, fmt, *args):
+        Domoticz.Error(fmt % args if args else fmt)
+        self.dump()
+
+    def mqtt(self, topic, rawmessage, prefix=''):
+        if self.ring != None:
+            self.ring.append((time.time(), prefix, topic, bytes(rawmessage)))
+        elif self.verbose:
+            DumpMQTTMessageToLog(topic, rawmessage, prefix)
+
+    def stateChange(self, unit, name, message):
+        now = time.time()
+        entry = self.stateLogged.get(unit)
+        if entry != None and now - entry[0] < self.stateLogInterval:
+            entry[1] += 1
+            return
+        skipped = ""
+        if entry != None and entry[1] > 0:
+            skipped = " (" + str(entry[1]) + " more since last logged)"
+        self.stateLogged[unit] = [now, 0]
+        Domoticz.Log(format(unit, '03d') + "/" + name + ": State change: '" + str(message) + skipped)
+
+    # Writes the buffered MQTT messages to the log
+    def dump(self):
+        if not self.ring:
+            return
+        Domoticz.Log("Last " + str(len(self.ring)) + " MQTT messages:")
+        for (t, prefix, topic, rawmessage) in self.ring:
+            DumpMQTTMessageToLog(topic, rawmessage, datetime.fromtimestamp(t).strftime('%H:%M:%S.%f ') + prefix)
+        self.ring.clear()
+
+pluginLog = PluginLog()
+
+
+class MqttCapture:
+    """Append-only capture of received PUBLISH messages.
+
+    The file starts with 'magic', then each record is a little-endian header
+    (timestamp as double, hub name length, topic length, payload length)
+    followed by the UTF-8 hub name, the UTF-8 topic and the raw payload bytes.
+    Files without 'magic' are captures of the earlier format, records without
+    a hub name; they can be read but are not appended to.
+    """
+    magic = b'MLCAP2\n'
+    header = struct.Struct('<dHHI')
+    oldHeader = struct.Struct('<dHI')
+
+    def __init__(self, filename, maxSize):
+        self.filename = filename
+        self.maxSize = maxSize
+        self.file = open(filename, 'ab+')
+        self.size = self.file.tell()
+        if self.size == 0:
+            self.file.write(self.magic)
+            self.size = len(self.magic)
+        else:
+            self.file.seek(0)
+            if self.file.read(len(self.magic)) != self.magic:
+                self.file.close()
+                self.file = None
+                raise IOError("'" + filename + "' is a capture of an earlier format, move it away to capture again")
+        Domoticz.Log("Capturing MQTT messages to '" + filename + "'")
+
+    def write(self, hub, topic, payload):
+        if self.file == None:
+            return
+        hub = hub.encode('utf8')
+        topic = topic.encode('utf8')
+        record = self.header.pack(time.time(), len(hub), len(topic), len(payload)) + hub + topic + bytes(payload)
+        if self.maxSize > 0 and self.size + len(record) > self.maxSize:
+            Domoticz.Log("Capture file '" + self.filename + "' reached " + str(self.size) + " bytes, capture stopped")
+            self.close()
+            return
+        self.file.write(record)
+        self.size += len(record)
+
+    def flush(self):
+        if self.file != None:
+            self.file.flush()
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+    # Yields (timestamp, hub name, topic, payload) for every complete record in a capture file,
+    # the hub name is "" for records of the earlier format
+    @staticmethod
+    def read(filename):
+        with open(filename, 'rb') as f:
+            hasHub = f.read(len(MqttCapture.magic)) == MqttCapture.magic
+            if not hasHub:
+                f.seek(0)
+            header = MqttCapture.header if hasHub else MqttCapture.oldHeader
+            while True:
+                data = f.read(header.size)
+                if len(data) < header.size:
+                    return
+                if hasHub:
+                    (timestamp, hubLen, topicLen, payloadLen) = header.unpack(data)
+                else:
+                    (timestamp, topicLen, payloadLen) = header.unpack(data)
+                    hubLen = 0
+                hub = f.read(hubLen)
+                topic = f.read(topicLen)
+                payload = f.read(payloadLen)
+                if len(payload) < payloadLen:
+                    return
+                yield (timestamp, hub.decode('utf8', 'replace'), topic.decode('utf8', 'replace'), payload)
+
+
+# Returns a new connection to the MQTT broker. The default is a framework connection with the MQTT protocol,
+# tools may replace it with any object providing Connect, Connecting, Connected, Send (the framework's
+# MQTT verbs) and Disconnect, whose events reach the plugin's onConnect, onMessage and onDisconnect.
+def domoticzTransport(name, address, port):
+    return Domoticz.Connection(Name=name, Transport="TCP/IP", Protocol="MQTT", Address=address, Port=port)
+
+mqttTransport = domoticzTransport
+
 class MqttClient:
+    Name = ""
     Address = ""
     Port = ""
     mqttConn = None
     isConnected = False
+    capture = None
+    idSuffix = "" # Keeps the client ID unique when several hubs use the same broker
+    queueSize = 100 # Messages kept (latest per topic) while disconnected
+    reconnectMaxDelay = 60
+    reconnectAttempts = 0
+    reconnectAt = None # Time of the next scheduled reconnect
     mqttConnectedCb = None
     mqttDisconnectedCb = None
     mqttPublishCb = None
 
-    def __init__(self, destination, port, mqttConnectedCb, mqttDisconnectedCb, mqttPublishCb, mqttSubackCb):
+    def __init__(self, name, destination, port, mqttConnectedCb, mqttDisconnectedCb, mqttPublishCb, mqttSubackCb):
         Domoticz.Debug("MqttClient::__init__")
+        self.Name = name
         self.Address = destination
         self.Port = port
         self.mqttConnectedCb = mqttConnectedCb
         self.mqttDisconnectedCb = mqttDisconnectedCb
         self.mqttPublishCb = mqttPublishCb
         self.mqttSubackCb = mqttSubackCb
+        self.queue = dict() # Key=topic, Value=(payload, retain), published once (re)subscribed
+        self.subscriptions = set() # Topic filters subscribed to in the current session
         self.Open()
 
     def __str__(self):
@@ -68,45 +228,86 @@ class MqttClient:
         if (self.mqttConn != None):
             self.Close()
         self.isConnected = False
-        self.mqttConn = Domoticz.Connection(Name=self.Address, Transport="TCP/IP", Protocol="MQTT", Address=self.Address, Port=self.Port)
+        self.reconnectAt = None
+        self.mqttConn = mqttTransport(self.Name, self.Address, self.Port)
         self.mqttConn.Connect()
 
+    # Schedules the next connection attempt with exponential backoff and jitter
+    def ScheduleReconnect(self):
+        delay = min(self.reconnectMaxDelay, 2 ** self.reconnectAttempts) * random.uniform(0.5, 1.0)
+        self.reconnectAttempts += 1
+        self.reconnectAt = time.time() + delay
+        Domoticz.Log("MqttClient::Reconnecting to "+self.Address+":"+self.Port+" in "+str(round(delay, 1))+"s")
+
+    # Opens the connection when a scheduled reconnect is due, returns True if it did
+    def CheckReconnect(self, now):
+        if self.reconnectAt != None and now >= self.reconnectAt:
+            self.Open()
+            return True
+        return False
+
     def Connect(self):
         Domoticz.Debug("MqttClient::Connect")
         if (self.mqttConn == None):
             self.Open()
         else:
-            ID = 'Domoticz_'+Parameters['Key']+'_'+str(Parameters['HardwareID'])+'_'+str(int(time.time()))
+            ID = 'Domoticz_'+Parameters['Key']+'_'+str(Parameters['HardwareID'])+self.idSuffix+'_'+str(int(time.time()))
             Domoticz.Log("MQTT CONNECT ID: '" + ID + "'")
             self.mqttConn.Send({'Verb': 'CONNECT', 'ID': ID})
 
     def Ping(self):
         #Domoticz.Debug("MqttClient::Ping")
-        if (self.mqttConn == None or not self.isConnected):
-            self.Open()
-        else:
+        if (self.mqttConn != None and self.isConnected):
             self.mqttConn.Send({'Verb': 'PING'})
 
     def Publish(self, topic, payload, retain = 0):
-        Domoticz.Debug("MqttClient::Publish " + topic + " (" + payload + ")")
-        if (self.mqttConn == None or not self.isConnected):
-            self.Open()
+        pluginLog.debug("MqttClient::Publish %s (%s)", topic, payload)
+        # The connection may have dropped before onDisconnect arrives
+        if (self.mqttConn == None or not self.isConnected or not self.mqttConn.Connected()):
+            # Keep the latest message per topic until connected again
+            self.queue.pop(topic, None)
+            if len(self.queue) >= self.queueSize:
+                dropped = next(iter(self.queue))
+                Domoticz.Log("MqttClient::Publish queue full, dropping message for " + dropped)
+                del self.queue[dropped]
+            self.queue[topic] = (payload, retain)
+            if self.mqttConn == None and self.reconnectAt == None:
+                self.Open()
         else:
             self.mqttConn.Send({'Verb': 'PUBLISH', 'Topic': topic, 'Payload': bytearray(payload, 'utf-8'), 'Retain': retain})
 
+    # Publishes the messages queued while disconnected, in order
+    def FlushQueue(self):
+        queue = self.queue
+        self.queue = dict()
+        if queue:
+            Domoticz.Debug("MqttClient::FlushQueue " + str(len(queue)) + " messages")
+        for topic, (payload, retain) in queue.items():
+            self.Publish(topic, payload, retain)
+
     def Subscribe(self, topics):
         Domoticz.Debug("MqttClient::Subscribe")
         subscriptionlist = []
         for topic in topics:
             subscriptionlist.append({'Topic':topic, 'QoS':0})
-        if (self.mqttConn == None or not self.isConnected):
-            self.Open()
-        else:
+        # Subscriptions are sent again once connected
+        if (self.mqttConn != None and self.isConnected):
             self.mqttConn.Send({'Verb': 'SUBSCRIBE', 'Topics': subscriptionlist})
+            self.subscriptions.update(topics)
+
+    def Unsubscribe(self, topics):
+        Domoticz.Debug("MqttClient::Unsubscribe")
+        if (self.mqttConn != None and self.isConnected):
+            self.mqttConn.Send({'Verb': 'UNSUBSCRIBE', 'Topics': list(topics)})
+        self.subscriptions.difference_update(topics)
 
     def Close(self):
         Domoticz.Log("MqttClient::Close")
-        #TODO: Disconnect from server
+        if self.mqttConn != None:
+            if self.isConnected:
+                self.mqttConn.Send({'Verb': 'DISCONNECT'})
+            if self.mqttConn.Connected() or self.mqttConn.Connecting():
+                self.mqttConn.Disconnect()
         self.mqttConn = None
         self.isConnected = False
 
@@ -117,11 +318,22 @@ class MqttClient:
             self.Connect()
         else:
             Domoticz.Log("Failed to connect to: "+Connection.Address+":"+Connection.Port+", Description: "+Description)
+            if Connection is self.mqttConn:
+                self.mqttConn = None
+                self.ScheduleReconnect()
 
     def onDisconnect(self, Connection):
         Domoticz.Log("MqttClient::onDisonnect Disconnected from: "+Connection.Address+":"+Connection.Port)
+        if Connection is not self.mqttConn:
+            return # Closed by us, or an earlier connection
+        self.isConnected = False
         self.Close()
-        # TODO: Reconnect?
+        # Reconnect right away the first time, then back off
+        if self.reconnectAttempts == 0:
+            self.reconnectAttempts = 1
+            self.Open()
+        else:
+            self.ScheduleReconnect()
         if self.mqttDisconnectedCb != None:
             self.mqttDisconnectedCb()
 
@@ -129,28 +341,731 @@ class MqttClient:
         topic = ''
         if 'Topic' in Data:
             topic = Data['Topic']
-        payloadStr = ''
-        if 'Payload' in Data:
-            payloadStr = Data['Payload'].decode('utf8','replace')
-            payloadStr = str(payloadStr.encode('unicode_escape'))
-        #Domoticz.Debug("MqttClient::onMessage called for connection: '"+Connection.Name+"' type:'"+Data['Verb']+"' topic:'"+topic+"' payload:'" + payloadStr + "'")
+        #pluginLog.debug("MqttClient::onMessage called for connection: '%s' type:'%s' topic:'%s'", Connection.Name, Data['Verb'], topic)
 
         if Data['Verb'] == "CONNACK":
             self.isConnected = True
+            self.reconnectAttempts = 0
+            self.subscriptions = set() # New session
             if self.mqttConnectedCb != None:
                 self.mqttConnectedCb()
 
         if Data['Verb'] == "SUBACK":
             if self.mqttSubackCb != None:
                 self.mqttSubackCb()
+            self.FlushQueue()
 
         if Data['Verb'] == "PUBLISH":
+            if self.capture != None:
+                self.capture.write(self.Name, topic, Data['Payload'])
             if self.mqttPublishCb != None:
                 self.mqttPublishCb(topic, Data['Payload'])
 
 CONF_DEVICE = 'device'
 TOPIC_BASE = '~'
 
+TOPIC_STATES = 'states'
+TOPIC_UPDATES = 'updates'
+TOPIC_COMMANDS = 'commands'
+
+KEEPALIVE_INTERVAL = 10 # Seconds between connection checks / pings
+SNAPSHOT_VERSION = 3
+MAX_UNIT = 255 # Domoticz limit of devices per hardware
+
+CONTROL_ACTIONS = {10:"Dump log", 20:"Profile", 30:"Discover"} # Control selector switch levels
+
+class TopicMatcher:
+    """Matches incoming topics against the states/updates topic patterns.
+
+    Patterns are compiled to regular expressions once, and the result for
+    recently seen topics (including misses) is kept in a bounded cache.
+    """
+    tokens = {':device_id':'device_id', ':hex_device_id':'device_id', ':device_type':'device_type', ':group_id':'group_id'}
+
+    def __init__(self, patterns, cacheSize=1024):
+        # patterns: list of (kind, topic pattern), tried in order
+        self.patterns = []
+        for kind, pattern in patterns:
+            regex = self.compile(pattern)
+            if regex != None:
+                self.patterns.append((kind, regex))
+            else:
+                Domoticz.Error("TopicMatcher: Pattern '" + pattern + "' needs :device_id, :device_type and :group_id")
+        self.cacheSize = cacheSize
+        self.cache = dict() # Key=topic, Value=match result or None
+
+    def compile(self, pattern):
+        fields = set()
+        parts = []
+        for item in pattern.split('/'):
+            field = self.tokens.get(item)
+            if field == None:
+                parts.append(re.escape(item))
+            elif field in fields:
+                parts.append('[^/]+')
+            else:
+                fields.add(field)
+                parts.append('(?P<' + field + '>[^/]+)')
+        if len(fields) != 3:
+            return None
+        return re.compile('/'.join(parts) + r'\Z')
+
+    # Returns (kind, device_id, device_type, group_id) or None
+    def match(self, topic):
+        try:
+            return self.cache[topic]
+        except KeyError:
+            pass
+        result = None
+        for kind, regex in self.patterns:
+            m = regex.match(topic)
+            if m:
+                result = (kind, m.group('device_id'), m.group('device_type'), m.group('group_id'))
+                break
+        if len(self.cache) >= self.cacheSize:
+            del self.cache[next(iter(self.cache))]
+        self.cache[topic] = result
+        return result
+
+
+class PayloadCache:
+    """Remembers the last payload bytes received per topic, to skip identical repeats.
+
+    A repeat older than 'maxAge' seconds (when not 0) is not skipped. At most
+    'size' topics are kept, the oldest is forgotten first.
+    """
+    def __init__(self, size, maxAge=0):
+        self.size = max(1, size)
+        self.maxAge = maxAge
+        self.cache = dict() # Key=topic, Value=(payload bytes, time received)
+
+    # Returns True if payload repeats the last one for topic, else remembers it
+    def seen(self, topic, payload, now):
+        entry = self.cache.get(topic)
+        if entry != None and entry[0] == payload and (self.maxAge <= 0 or now - entry[1] < self.maxAge):
+            return True
+        if entry != None:
+            del self.cache[topic]
+        elif len(self.cache) >= self.size:
+            del self.cache[next(iter(self.cache))]
+        self.cache[topic] = (bytes(payload), now)
+        return False
+
+    def forget(self, topic):
+        self.cache.pop(topic, None)
+
+
+class Coalescer:
+    """Merges dict payloads per key, later fields overriding earlier ones.
+
+    An entry is released 'window' seconds after the first payload for its key
+    arrived. When the buffer is full the oldest entry is released early.
+    """
+    def __init__(self, window, maxSize):
+        self.window = window
+        self.maxSize = max(1, maxSize)
+        self.pending = dict() # Key=key, Value=[time first seen, merged payload]
+
+    def __len__(self):
+        return len(self.pending)
+
+    # Returns list of (key, payload) released to make room
+    def add(self, key, payload, now):
+        entry = self.pending.get(key)
+        if entry != None:
+            entry[1].update(payload)
+            return []
+        released = []
+        while len(self.pending) >= self.maxSize:
+            oldest = next(iter(self.pending))
+            released.append((oldest, self.pending.pop(oldest)[1]))
+        self.pending[key] = [now, dict(payload)]
+        return released
+
+    # Returns list of (key, payload) whose window has elapsed, everything if now is None
+    def due(self, now=None):
+        released = []
+        for key, entry in self.pending.items():
+            if now != None and now - entry[0] < self.window:
+                break
+            released.append((key, entry[1]))
+        for key, payload in released:
+            del self.pending[key]
+        return released
+
+    # Returns the merged payload pending for key and removes it, None if there is none
+    def pop(self, key):
+        entry = self.pending.pop(key, None)
+        return entry[1] if entry != None else None
+
+    # Returns list of (key, payload) for which test(key) is true, removing them
+    def release(self, test):
+        released = [(key, entry[1]) for key, entry in self.pending.items() if test(key)]
+        for key, payload in released:
+            del self.pending[key]
+        return released
+
+class CommandScheduler:
+    """Debounces and rate limits command payloads per commands topic.
+
+    Payloads for the same topic are merged latest-wins until 'window' seconds
+    after the first one; priority payloads (On/Off) are due after their 'hold'
+    time, usually immediately, and sent before the others. At most 'rate'
+    messages per second are released.
+    """
+    exclusiveKeys = ('color', 'command', 'temperature', 'mode') # A newer payload setting one of these replaces all of them
+
+    def __init__(self, window, rate, maxSize):
+        self.window = window
+        self.rate = float(max(1, rate))
+        self.maxSize = max(1, maxSize)
+        self.tokens = self.rate
+        self.lastRefill = 0
+        self.pending = dict() # Key=topic, Value=[time first seen, merged payload, priority, seconds until due]
+
+    def __len__(self):
+        return len(self.pending)
+
+    # Returns list of (topic, payload) released to make room. 'hold' delays a priority payload,
+    # e.g. so that the same command for the other groups of a remote can be collapsed with it.
+    def add(self, topic, payload, priority, now, hold=0):
+        entry = self.pending.get(topic)
+        if entry != None:
+            merged = entry[1]
+            if any(k in payload for k in self.exclusiveKeys):
+                for k in self.exclusiveKeys:
+                    merged.pop(k, None)
+            merged.update(payload)
+            if priority:
+                entry[2] = True
+                entry[3] = min(entry[3], hold)
+            return []
+        released = []
+        while len(self.pending) >= self.maxSize:
+            oldest = next(iter(self.pending))
+            released.append((oldest, self.pending.pop(oldest)[1]))
+        self.pending[topic] = [now, dict(payload), priority, hold if priority else self.window]
+        return released
+
+    # Returns list of (topic, payload) to send now, within the rate budget
+    def due(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+        released = []
+        for wantPriority in (True, False):
+            for topic, entry in self.pending.items():
+                if self.tokens < 1:
+                    break
+                if entry[2] == wantPriority and now - entry[0] >= entry[3]:
+                    released.append((topic, entry[1]))
+                    self.tokens -= 1
+        for topic, payload in released:
+            del self.pending[topic]
+        return released
+
+    # Replaces identical due payloads for every group of a remote by one payload for group 0.
+    # groupOf(topic) returns (group 0 topic, tuple of the topics of all groups) or None.
+    # Returns the number of payloads saved.
+    def collapseGroups(self, now, groupOf):
+        remotes = dict()
+        for topic, entry in self.pending.items():
+            if entry[2] or now - entry[0] >= self.window:
+                group = groupOf(topic)
+                if group != None:
+                    remotes.setdefault(group, []).append(topic)
+        saved = 0
+        for (groupTopic, members), topics in remotes.items():
+            if len(topics) != len(members) or groupTopic in self.pending:
+                continue
+            payload = self.pending[topics[0]][1]
+            if any(self.pending[t][1] != payload for t in topics):
+                continue
+            entries = [self.pending.pop(t) for t in topics]
+            priority = any(e[2] for e in entries)
+            # Nothing left to wait for once collapsed
+            self.pending[groupTopic] = [min(e[0] for e in entries), payload, priority, 0 if priority else self.window]
+            saved += len(topics) - 1
+        return saved
+
+class Hub:
+    """One ESP8266 Milight hub: its MQTT connection, topic patterns and command scheduler."""
+    def __init__(self, name, address, port, commands_topic_format, states_topic_format, updates_topic_format):
+        self.name = name
+        self.address = address
+        self.port = port
+        self.commands_topic_format = commands_topic_format
+        self.states_topic_format = states_topic_format
+        self.updates_topic_format = updates_topic_format
+        self.key = name # Hub part of the device keys, "" for the primary hub
+        self.topicMatcher = None
+        self.commandMatcher = None
+        self.mqttClient = None
+        self.outbound = None
+        self.payloadCache = None
+
+    def __str__(self):
+        return "Hub '" + self.name + "' (" + self.address + ":" + str(self.port) + ")"
+
+
+class PendingCommand:
+    """A published command waiting for the hub to report the matching state."""
+    __slots__ = ('hub', 'topic', 'payloadstring', 'status', 'sent', 'attempts')
+
+    def __init__(self, hub, topic, payloadstring, status, sent):
+        self.hub = hub
+        self.topic = topic
+        self.payloadstring = payloadstring
+        self.status = status # 'ON'/'OFF' when the command switches the light, else None
+        self.sent = sent
+        self.attempts = 1
+
+
+class Transition:
+    """A fade stepped by the plugin, for devices whose hub cannot do it itself.
+
+    'start' and 'target' hold 'level', 'temperature' and 'color' ({'r', 'g', 'b'}) values,
+    'extra' the other fields of the command, sent with the first step.
+    """
+    __slots__ = ('hub', 'topic', 'start', 'target', 'extra', 'began', 'duration', 'nextStep', 'last')
+
+    def __init__(self, hub, topic, start, target, extra, began, duration, interval):
+        self.hub = hub
+        self.topic = topic
+        self.start = start
+        self.target = target
+        self.extra = extra
+        self.began = began
+        self.duration = duration
+        self.nextStep = began + interval # The light is at 'start' already
+        self.last = None # Payload of the last step sent
+
+    # Returns (payload at time 'now', True if the target is reached)
+    def payloadAt(self, now):
+        f = min(1.0, (now - self.began) / self.duration)
+        payload = dict()
+        for k, target in self.target.items():
+            start = self.start.get(k, target)
+            if k == 'color':
+                payload[k] = {c: int(round(start[c] + (target[c] - start[c]) * f)) for c in ('r', 'g', 'b')}
+            else:
+                payload[k] = int(round(start + (target - start) * f))
+        return (payload, f >= 1.0)
+
+
+class Metrics:
+    """Counters and latency histograms, reset every time a summary is taken."""
+    bounds = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000, 100000, 200000, 500000, 1000000, 2000000, 5000000) # Histogram bucket upper bounds in microseconds
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = dict() # Key=name, Value=count
+        self.latencies = dict() # Key=name, Value=[count, total seconds, max seconds, bucket counts]
+        self.since = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def time(self, name, seconds):
+        entry = self.latencies.get(name)
+        if entry == None:
+            entry = self.latencies[name] = [0, 0.0, 0.0, [0] * (len(self.bounds) + 1)]
+        entry[0] += 1
+        entry[1] += seconds
+        if seconds > entry[2]:
+            entry[2] = seconds
+        us = seconds * 1000000
+        i = 0
+        for bound in self.bounds:
+            if us <= bound:
+                break
+            i += 1
+        entry[3][i] += 1
+
+    # Returns upper bound in microseconds of the bucket holding the given percentile
+    def percentile(self, entry, pct):
+        target = entry[0] * pct / 100.0
+        seen = 0
+        for i, n in enumerate(entry[3]):
+            seen += n
+            if seen >= target:
+                return self.bounds[i] if i < len(self.bounds) else int(entry[2] * 1000000)
+        return 0
+
+    def summary(self):
+        parts = []
+        if self.counters:
+            parts.append(" ".join(name + "=" + str(n) for name, n in sorted(self.counters.items())))
+        for name, entry in sorted(self.latencies.items()):
+            parts.append(name + " n=" + str(entry[0]) + " avg=" + str(int(entry[1] / entry[0] * 1000000)) + "us p50<=" + str(self.percentile(entry, 50)) +
+                         "us p99<=" + str(self.percentile(entry, 99)) + "us max=" + str(int(entry[2] * 1000000)) + "us")
+        return "last " + str(int(time.time() - self.since)) + "s: " + "; ".join(parts)
+
+# Method decorator recording the call latency in self.metrics
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args):
+            start = time.perf_counter()
+            try:
+                return fn(self, *args)
+            finally:
+                self.metrics.time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class Profiler:
+    """cProfile of the plugin entry points, for a bounded window."""
+    def __init__(self):
+        self.profile = None # Active cProfile.Profile
+        self.until = 0
+        self.depth = 0
+
+    # Starts profiling, or extends the running window
+    def start(self, window, now):
+        if self.profile == None:
+            self.profile = cProfile.Profile()
+        self.until = now + window
+
+    def enter(self):
+        if self.depth == 0:
+            self.profile.enable()
+        self.depth += 1
+
+    def exit(self):
+        self.depth -= 1
+        if self.depth == 0:
+            self.profile.disable()
+
+    # Ends profiling, writes the statistics to 'basename'.pstats and the hottest functions to 'basename'.txt
+    def finish(self, basename):
+        profile = self.profile
+        self.profile = None
+        profile.dump_stats(basename + '.pstats')
+        with open(basename + '.txt', 'w') as f:
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats('tottime').print_stats(30)
+            stats.sort_stats('cumulative').print_stats(30)
+
+# Method decorator running the call under self.profiler while it is active
+def profiled(fn):
+    @functools.wraps(fn)
+    def wrapper(self, *args):
+        profiler = self.profiler
+        if profiler.profile == None:
+            return fn(self, *args)
+        profiler.enter()
+        try:
+            return fn(self, *args)
+        finally:
+            profiler.exit()
+            if profiler.depth == 0 and time.time() >= profiler.until:
+                self.finishProfile()
+    return wrapper
+
+class LightState:
+    """Decoded state of one light device, kept in sync with every device.Update.
+
+    Color components are None when the device's Color does not hold them.
+    """
+    __slots__ = ('nValue', 'sValue', 'm', 't', 'r', 'g', 'b', 'cw', 'ww', 'hue', 'sat', 'capability', 'lastUpdate')
+
+    # Decoded fields persisted in the snapshot, nValue and sValue are stored with the device
+    SNAPSHOT_FIELDS = ('m', 't', 'r', 'g', 'b', 'cw', 'ww', 'hue', 'sat')
+
+    def toList(self):
+        return [getattr(self, k) for k in LightState.SNAPSHOT_FIELDS]
+
+    @staticmethod
+    def fromList(values, nValue, sValue, capability):
+        state = LightState()
+        for k, v in zip(LightState.SNAPSHOT_FIELDS, values):
+            setattr(state, k, v)
+        state.nValue = nValue
+        state.sValue = sValue
+        state.capability = capability
+        state.lastUpdate = 0
+        return state
+
+    def copy(self):
+        other = LightState()
+        other.nValue = self.nValue
+        other.sValue = self.sValue
+        other.m = self.m
+        other.t = self.t
+        other.r = self.r
+        other.g = self.g
+        other.b = self.b
+        other.cw = self.cw
+        other.ww = self.ww
+        other.hue = self.hue
+        other.sat = self.sat
+        other.capability = self.capability
+        other.lastUpdate = self.lastUpdate
+        return other
+
+    # Returns the Domoticz Color dict for this state
+    def color(self):
+        Color = dict()
+        for k in ('m', 't', 'r', 'g', 'b', 'cw', 'ww'):
+            v = getattr(self, k)
+            if v != None:
+                Color[k] = v
+        return Color
+
+# Domoticz stores levels and color components as integers, compare accordingly
+def sameLevel(a, b):
+    if a == None or b == None:
+        return a == b
+    try:
+        return int(a) == int(b)
+    except (ValueError, TypeError) as e:
+        return a == b
+
+# ==========================================================DEVICE CAPABILITIES===========================================================
+# Handlers applying one field of a hub state message to a LightState
+
+def applyState(state, message):
+    if message['state']=='ON':
+        state.nValue = 1
+    elif message['state']=='OFF':
+        state.nValue = 0
+
+def applyBrightness(state, message):
+    state.sValue = str(int(message['brightness']*100/255))
+
+def applyColorTemp(state, message):
+    state.t = mired_to_t(message['color_temp'])
+
+def applyHue(state, message):
+    state.hue = message['hue']
+    (state.r, state.g, state.b) = hs_to_rgb(state.hue, state.sat)
+
+def applySaturation(state, message):
+    state.sat = message['saturation']
+    (state.r, state.g, state.b) = hs_to_rgb(state.hue, state.sat)
+
+def applyColor(state, message):
+    col = message['color']
+    if 'r' in col:
+        state.r = col['r']
+    if 'g' in col:
+        state.g = col['g']
+    if 'b' in col:
+        state.b = col['b']
+    if state.r != None and state.g != None and state.b != None:
+        (state.hue, state.sat) = rgb_to_hs(state.r, state.g, state.b)
+
+class Capability:
+    """What one kind of light supports: the Domoticz device it is created as and the
+    handlers for the hub state fields it reports, in the order they are applied."""
+    def __init__(self, name, Type, SubType, Switchtype, hasCCT, hasRGB):
+        self.name = name
+        self.Type = Type
+        self.SubType = SubType
+        self.Switchtype = Switchtype
+        self.hasCCT = hasCCT
+        self.hasRGB = hasRGB
+        handlers = [('state', applyState), ('brightness', applyBrightness), ('bulb_mode', self.applyBulbMode)]
+        if hasCCT:
+            handlers.append(('color_temp', applyColorTemp))
+        if hasRGB:
+            handlers += [('hue', applyHue), ('saturation', applySaturation), ('color', applyColor)]
+        self.handlers = tuple(handlers)
+
+    def applyBulbMode(self, state, message):
+        if message['bulb_mode']=='white':
+            if self.hasCCT:
+                state.m = 2
+            else:
+                state.m = 1
+        elif (message['bulb_mode']=='rgb' or message['bulb_mode']=='color') and self.hasRGB:
+            state.m = 3
+        elif message['bulb_mode']=='scene' and 'mode' in message:
+            state.nValue = 24+message['mode']
+            state.sValue = "Disco Mode "+str(message['mode']+1)
+
+    # Applies the fields of a hub state message this kind of light supports
+    def apply(self, state, message):
+        for field, handler in self.handlers:
+            if field in message:
+                handler(state, message)
+
+CAPABILITY_RGBCCT = Capability("RGBCCT", 0xf1, 0x04, 7, True, True)  # pTypeColorSwitch, sTypeColor_RGB_CW_WW, Dimmer
+CAPABILITY_CCT = Capability("CCT", 0xf1, 0x08, 7, True, False)
+CAPABILITY_RGBW = Capability("RGBW", 0xf1, 0x01, 7, True, True)      # sTypeColor_RGB_W
+CAPABILITY_RGB = Capability("RGB", 0xf1, 0x02, 7, True, True)        # sTypeColor_RGB
+CAPABILITY_DIMMER = Capability("DIMMER", 0xf4, 0x49, 7, False, False) # pTypeGeneralSwitch, sSwitchGeneralSwitch
+
+class DeviceType:
+    """What the plugin knows about one hub device_type (remote type)."""
+    def __init__(self, name, capability, groups, hubTransitions, levelSteps):
+        self.name = name
+        self.capability = capability # Capability of the devices created for it
+        self.groups = groups # Groups addressed by group 0
+        self.hubTransitions = hubTransitions # The hub fades to a 'transition' payload itself (firmware 1.10 and later)
+        self.levelSteps = levelSteps # No absolute brightness, the hub handles 'level_up'/'level_down'
+
+# Supported hub device types, a new remote type only needs an entry here
+DEVICE_TYPES = {t.name:t for t in (DeviceType('rgb_cct', CAPABILITY_RGBCCT, 4, True, False),
+                                   DeviceType('fut089', CAPABILITY_RGBCCT, 8, True, False),
+                                   DeviceType('cct', CAPABILITY_CCT, 4, False, True),
+                                   DeviceType('fut091', CAPABILITY_CCT, 4, True, False),
+                                   DeviceType('rgbw', CAPABILITY_RGBW, 4, True, False),
+                                   DeviceType('rgb', CAPABILITY_RGB, 1, False, True))}
+DEVICE_TYPE_CAPABILITIES = {n:t.capability for n, t in DEVICE_TYPES.items()}
+GROUP_COUNTS = {n:t.groups for n, t in DEVICE_TYPES.items()}
+DEFAULT_GROUP_COUNT = 7
+HUB_TRANSITION_TYPES = tuple(n for n, t in DEVICE_TYPES.items() if t.hubTransitions)
+LEVEL_STEP_TYPES = tuple(n for n, t in DEVICE_TYPES.items() if t.levelSteps)
+# Capability by Domoticz (Type, SubType), other devices get on/off, level and scenes only
+SUBTYPE_CAPABILITIES = {(c.Type, c.SubType):c for c in (CAPABILITY_RGBCCT, CAPABILITY_CCT, CAPABILITY_RGBW, CAPABILITY_RGB, CAPABILITY_DIMMER)}
+# Tags in a device name that change the device type, "@RGBCCT" before "@RGB"
+NAME_TAG_CAPABILITIES = (("@RGBCCT", CAPABILITY_RGBCCT), ("@CCT", CAPABILITY_CCT), ("@RGBW", CAPABILITY_RGBW), ("@RGB", CAPABILITY_RGB),
+                         ("@DIMMER", CAPABILITY_DIMMER))
+
+def capabilityOf(Type, SubType):
+    return SUBTYPE_CAPABILITIES.get((Type, SubType), CAPABILITY_DIMMER)
+
+# ==========================================================COLOR CONVERSION==============================================================
+MIRED_MIN = 153 # Hub color_temp range, mapped onto Domoticz 't' 0..255
+MIRED_MAX = 370
+
+def compute_hs_to_rgb(h, s):
+    if s == 0: return (255, 255, 255)
+    i = int(h*6.0/360) # XXX assume int() truncates!
+    f = (h*6.0/360)-i
+    p = 255*(1.0-s/100)
+    q = int(255*(1.0-s/100*f))
+    t = int(255*(1.0-s/100*(1.0-f)))
+    i%=6
+    if i == 0: return (255, t, p)
+    if i == 1: return (q, 255, p)
+    if i == 2: return (p, 255, t)
+    if i == 3: return (p, q, 255)
+    if i == 4: return (t, p, 255)
+    if i == 5: return (255, p, q)
+
+def rgb_to_hs(r,g,b):
+    cmin = min(r,g,b)
+    cmax = max(r,g,b)
+    delta = cmax - cmin
+    hue = 0
+    sat = 0
+    if delta>0:
+        if r==cmax:
+            hue = int((g-b)*60/delta)
+        elif g==cmax:
+            hue = int(120 + (b-r)*60/delta)
+        else:
+            hue = int(240 + (r-g)*60/delta)
+        if hue<0:
+            hue = hue+360
+        elif hue>360:
+            hue = hue-360
+        
+        if cmax>0:
+            sat = int(delta/cmax*100)
+    
+    return (hue, sat)
+
+# Lookup tables; hue/saturation entries are filled the first time a pair is used, so only the colours in use take memory
+HS_RGB_ROWS = [None] * 361 # Index=hue 0..360, Value=list of rgb tuples (None until used) for saturation 0..100
+MIRED_T = [int(m-MIRED_MIN)*255/(MIRED_MAX-MIRED_MIN) for m in range(MIRED_MIN, MIRED_MAX+1)] # Index=mired-MIRED_MIN
+T_TEMPERATURE = [int(t*100/255) for t in range(256)] # Index=Domoticz 't', Value=hub temperature 0..100
+T_MIRED = [MIRED_MIN + t*(MIRED_MAX-MIRED_MIN)/255 for t in range(256)] # Index=Domoticz 't'
+
+def hs_to_rgb(h, s):
+    if type(h) == int and type(s) == int and 0 <= h <= 360 and 0 <= s <= 100:
+        row = HS_RGB_ROWS[h]
+        if row == None:
+            row = HS_RGB_ROWS[h] = [None] * 101
+        rgb = row[s]
+        if rgb == None:
+            rgb = row[s] = compute_hs_to_rgb(h, s)
+        return rgb
+    return compute_hs_to_rgb(h, s)
+
+# Hub color_temp (mireds) to Domoticz 't'
+def mired_to_t(color_temp):
+    color_temp = int(color_temp)
+    if MIRED_MIN <= color_temp <= MIRED_MAX:
+        return MIRED_T[color_temp-MIRED_MIN]
+    return int(color_temp-MIRED_MIN)*255/(MIRED_MAX-MIRED_MIN)
+
+# Domoticz 't' to hub color_temp (mireds)
+def t_to_mired(t):
+    if type(t) == int and 0 <= t <= 255:
+        return T_MIRED[t]
+    return MIRED_MIN + t*(MIRED_MAX-MIRED_MIN)/255
+
+# Domoticz 't' to hub temperature (0..100)
+def t_to_temperature(t):
+    if type(t) == int and 0 <= t <= 255:
+        return T_TEMPERATURE[t]
+    return int(t*100/255)
+
+numpy = None
+
+# Returns the numpy module if it can be used, imported on first use only
+def get_numpy():
+    global numpy
+    if numpy == None:
+        try:
+            import numpy as np
+            numpy = np
+        except ImportError:
+            numpy = False
+    return numpy
+
+# Converts a sequence of (h, s) to a list of (r, g, b); use_numpy None = when available for large batches
+def hs_to_rgb_batch(hs, use_numpy=None):
+    np = get_numpy() if use_numpy != False else False
+    if not np or (use_numpy == None and len(hs) < 256):
+        return [hs_to_rgb(h, s) for (h, s) in hs]
+    a = np.asarray(hs, dtype=np.float64).reshape(-1, 2)
+    h = a[:, 0]
+    s = a[:, 1]
+    x = h*6.0/360
+    i = np.trunc(x)
+    f = x-i
+    p = 255*(1.0-s/100)
+    q = np.trunc(255*(1.0-s/100*f))
+    t = np.trunc(255*(1.0-s/100*(1.0-f)))
+    i = np.mod(i, 6)
+    full = np.full_like(p, 255.0)
+    r = np.select([i == 0, i == 1, i == 2, i == 3, i == 4], [full, q, p, p, t], full)
+    g = np.select([i == 0, i == 1, i == 2, i == 3, i == 4], [t, full, full, q, p], p)
+    b = np.select([i == 0, i == 1, i == 2, i == 3, i == 4], [p, p, t, full, full], q)
+    white = s == 0
+    rgb = np.stack([np.where(white, 255.0, r), np.where(white, 255.0, g), np.where(white, 255.0, b)], axis=1)
+    return [tuple(v) for v in rgb.tolist()]
+
+# Converts a sequence of (r, g, b) to a list of (h, s); use_numpy None = when available for large batches
+def rgb_to_hs_batch(rgb, use_numpy=None):
+    np = get_numpy() if use_numpy != False else False
+    if not np or (use_numpy == None and len(rgb) < 256):
+        return [rgb_to_hs(r, g, b) for (r, g, b) in rgb]
+    a = np.asarray(rgb, dtype=np.float64).reshape(-1, 3)
+    r = a[:, 0]
+    g = a[:, 1]
+    b = a[:, 2]
+    cmax = a.max(axis=1)
+    delta = cmax - a.min(axis=1)
+    d = np.where(delta > 0, delta, 1)
+    hue = np.where(r == cmax, np.trunc((g-b)*60/d), np.where(g == cmax, np.trunc(120 + (b-r)*60/d), np.trunc(240 + (r-g)*60/d)))
+    hue = np.where(hue < 0, hue+360, np.where(hue > 360, hue-360, hue))
+    sat = np.trunc(delta/np.where(cmax > 0, cmax, 1)*100)
+    valid = delta > 0
+    hue = np.where(valid, hue, 0).astype(np.int64)
+    sat = np.where(valid & (cmax > 0), sat, 0).astype(np.int64)
+    return list(zip(hue.tolist(), sat.tolist()))
+
+
+# Returns a device key as text, "[hub/]device_id/device_type/group_id"
+def keyName(key):
+    return "/".join(key if key[0] else key[1:])
 
 
 class BasePlugin:
@@ -159,9 +1074,60 @@ class BasePlugin:
     mqttserveraddress = ""
     mqttserverport = ""
     debugging = "Normal"
-    registeredDevices = dict() #Key=topic, Value=Device Unit
+    deviceIndex = dict() #Key=(hub key, device_id, device_type, group_id), Value=Device Unit
+    deviceKeys = dict() #Key=Device Unit, Value=(hub key, device_id, device_type, group_id)
+    groupMembers = dict() #Key=(hub key, device_id, device_type), Value=list of Device Units of groups 1..N
+    shadow = dict() #Key=Device Unit, Value=LightState
+    metrics = Metrics()
+    profiler = Profiler()
+    nextMetricsReport = 0
+    hubs = [] #Primary hub (from the hardware settings) first
+    pendingCommands = dict() #Key=(hub key, device_id, device_type, group_id), Value=PendingCommand
+    transitions = dict() #Key=Device Unit, Value=Transition stepped by the plugin
+    freeUnits = [] #Heap of units without a device
+    discovery = dict() #Key=(hub key, device_id, device_type, group_id) of a device to create, Value=[Hub, latest state message]
+    overflowKeys = set() #Devices that could not be created because all units are in use
+    hubsByName = dict() #Key=hub name, Value=Hub
+    inbound = None
+    nextKeepalive = 0
+    heartbeatInterval = 0
+    snapshotDirty = False
+    nextSnapshot = 0
+    subscriptionsDirty = False #Device index changed since the subscriptions were updated
+    discoveryUntil = 0 #End of the discovery window, 0 = closed
 
     options = {"addDiscoveredDeviceUsed":True, # Newly discovered devices added as "used" (visible in swithces tab) or not (only visible in devices list)
+               "topicCacheSize":1024,         # Number of recently seen topics for which the match result is cached
+               "forceUpdateInterval":0,       # Seconds after which an unchanged state is written to Domoticz anyway (0 = never)
+               "payloadCacheSize":1024,       # Number of states topics whose last payload is kept to skip identical repeats (0 = off)
+               "coalesceWindow":0,            # Milliseconds during which state messages for the same device are merged (0 = handle immediately)
+               "coalesceBufferSize":256,      # Maximum number of devices with merged state messages pending
+               "commandDebounce":0,           # Milliseconds during which commands for the same device are merged (0 = publish immediately)
+               "commandRate":10,              # Maximum number of commands published per second when debouncing
+               "commandBufferSize":256,       # Maximum number of devices per hub with debounced commands pending
+               "commandCollapse":True,        # When debouncing, send one group 0 command when all groups of a remote get the same command
+               "commandCollapseWindow":100,   # Milliseconds On/Off for a remote with collapsible groups wait for the other groups
+               "captureFile":"",              # File in the plugin folder to which received MQTT messages are appended ("" = no capture)
+               "captureMaxSize":50000000,     # Capture stops when the file reaches this many bytes (0 = no limit)
+               "metricsReport":"debug",       # Where to report metrics: "debug" (debug log), "log", "device" (text sensor) or "none"
+               "metricsInterval":60,          # Seconds between metrics reports
+               "stateLogInterval":10,         # Seconds between logged state changes of the same device
+               "logRingSize":200,             # Number of MQTT messages kept in memory in "Verbose" mode
+               "controlDevice":False,         # Create a selector switch with plugin actions (dump log)
+               "commandTimeout":0,            # Seconds to wait for the state matching a published command before resending it (0 = no tracking)
+               "commandRetries":2,            # Number of times an unacknowledged command is resent
+               "publishQueueSize":100,        # Commands kept per hub (latest per device) while disconnected from the broker
+               "reconnectMaxDelay":60,        # Maximum seconds between reconnect attempts
+               "snapshotInterval":300,        # Seconds between saves of the device registry snapshot used at startup (0 = no snapshot)
+               "transitionDuration":0,        # Seconds over which Set Level/Set Color fade to the new value (0 = immediately), device Option 'transition' overrides it
+               "hubTransitions":True,         # Let the hub fade (firmware 1.10 and later) where the device type allows it, else the plugin steps
+               "transitionStepInterval":1,    # Seconds between commands when the plugin steps a fade
+               "discoveryBatchSize":10,       # Devices created per heartbeat when new devices are discovered (0 = create immediately)
+               "profile":False,               # Profile onMessage, onCommand and onHeartbeat for profileWindow seconds after start
+               "profileWindow":60,            # Seconds profiled, from start or from the "Profile" control action
+               "subscriptionMode":"wildcard", # Topics subscribed to: "wildcard" (every remote), "device_id" or "remote" (device_id/device_type) of known devices only
+               "discoveryWindow":300,         # Seconds all remotes are subscribed to after the "Discover" action or a start without devices, in the narrowed modes
+               "hubs":[],                     # Additional hubs: list of {"name", "address", "port", "commands", "states", "updates"}
               }
 
     def deviceStr(self, unit):
@@ -181,19 +1147,17 @@ class BasePlugin:
 
         # Parse options
         self.debugging = Parameters["Mode6"]
-        DumpConfigToLog()
+        if self.debugging != "Normal":
+            DumpConfigToLog()
         if self.debugging == "Verbose+":
             Domoticz.Debugging(2+4+8+16+64)
         if self.debugging == "Verbose":
-            Domoticz.Debugging(2+4+8+16+64)
+            # No framework connection/message dumps (16, 64), MQTT messages go to the ring buffer instead
+            Domoticz.Debugging(2+4+8)
         if self.debugging == "Debug":
             Domoticz.Debugging(2+4+8)
         self.mqttserveraddress = Parameters["Address"].replace(" ", "")
         self.mqttserverport = Parameters["Port"].replace(" ", "")
-        self.commands_topic_format = Parameters["Mode2"]
-        self.states_topic_format = Parameters["Mode3"]
-        self.updates_topic_format = Parameters["Mode4"]
-        
 
         options = ""
         try:
@@ -202,119 +1166,437 @@ class BasePlugin:
             options = ""
 
         if type(options) == dict:
-            self.options.add(options)
+            self.options.update(options)
         Domoticz.Log("Plugin options: " + str(self.options))
-
-        # Enable heartbeat
-        Domoticz.Heartbeat(10)
-
-        # Connect to MQTT server
-        self.mqttClient = MqttClient(self.mqttserveraddress, self.mqttserverport, self.onMQTTConnected, self.onMQTTDisconnected, self.onMQTTPublish, self.onMQTTSubscribed)
-
+        pluginLog.configure(self.debugging, self.options['logRingSize'], self.options['stateLogInterval'])
+
+        self.metrics = Metrics()
+        self.profiler = Profiler()
+        if self.options['profile']:
+            self.startProfile()
+        self.nextMetricsReport = time.time() + self.options['metricsInterval']
+        self.makeHubs()
+        self.buildDeviceIndex(self.loadSnapshot())
+        self.nextSnapshot = time.time() + self.options['snapshotInterval']
+        if self.options['controlDevice']:
+            self.getControlDevice()
+
+        if self.options['coalesceWindow'] > 0:
+            self.inbound = Coalescer(self.options['coalesceWindow']/1000.0, self.options['coalesceBufferSize'])
+
+        capture = None
+        if self.options['captureFile']:
+            try:
+                capture = MqttCapture(os.path.join(Parameters["HomeFolder"], self.options['captureFile']), self.options['captureMaxSize'])
+            except (OSError, IOError) as e:
+                Domoticz.Error("Cannot open capture file: " + str(e))
+
+        # Connect to MQTT servers
+        for hub in self.hubs:
+            hub.mqttClient = MqttClient(hub.name, hub.address, hub.port, functools.partial(self.onMQTTConnected, hub), functools.partial(self.onMQTTDisconnected, hub),
+                                        lambda topic, rawmessage, hub=hub: self.onMQTTPublish(topic, rawmessage, hub), functools.partial(self.onMQTTSubscribed, hub))
+            hub.mqttClient.capture = capture
+            hub.mqttClient.queueSize = self.options['publishQueueSize']
+            hub.mqttClient.reconnectMaxDelay = self.options['reconnectMaxDelay']
+            if hub is not self.hubs[0]:
+                hub.mqttClient.idSuffix = '_' + hub.name
+        self.mqttClient = self.hubs[0].mqttClient
+        if self.options['subscriptionMode'] != "wildcard" and not self.deviceKeys:
+            self.startDiscovery()
+        self.updateHeartbeat()
+
+    # Enables the heartbeat, every second when merged messages, pending commands or reconnects need it
+    def updateHeartbeat(self):
+        interval = KEEPALIVE_INTERVAL
+        if self.inbound != None or self.options['commandDebounce'] > 0 or self.options['commandTimeout'] > 0:
+            interval = 1
+        elif self.transitions or self.discovery or any(hub.mqttClient.reconnectAt != None for hub in self.hubs):
+            interval = 1
+        if interval != self.heartbeatInterval:
+            self.heartbeatInterval = interval
+            Domoticz.Heartbeat(interval)
+
+    # Creates the primary hub from the hardware settings and the additional hubs from the "hubs" option
+    def makeHubs(self):
+        primary = Hub(self.mqttserveraddress, self.mqttserveraddress, self.mqttserverport, Parameters["Mode2"], Parameters["Mode3"], Parameters["Mode4"])
+        primary.key = ""
+        self.hubs = [primary]
+        self.hubsByName = dict()
+        for config in self.options['hubs']:
+            try:
+                name = str(config['name'])
+                if name == "" or name == primary.name or name in self.hubsByName:
+                    raise ValueError("hub name '" + name + "' is empty or not unique")
+                hub = Hub(name, str(config.get('address', primary.address)).replace(" ", ""), str(config.get('port', primary.port)).replace(" ", ""),
+                          config.get('commands', primary.commands_topic_format), config.get('states', primary.states_topic_format), config.get('updates', primary.updates_topic_format))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                Domoticz.Error("Ignoring hub " + str(config) + ": " + str(e))
+                continue
+            self.hubs.append(hub)
+            self.hubsByName[name] = hub
+        for hub in self.hubs:
+            Domoticz.Log(str(hub))
+            hub.topicMatcher = TopicMatcher([(TOPIC_STATES, hub.states_topic_format), (TOPIC_UPDATES, hub.updates_topic_format)], self.options['topicCacheSize'])
+            hub.commandMatcher = TopicMatcher([(TOPIC_COMMANDS, hub.commands_topic_format)], self.options['topicCacheSize'])
+            if self.options['payloadCacheSize'] > 0:
+                hub.payloadCache = PayloadCache(self.options['payloadCacheSize'], self.options['forceUpdateInterval'])
+            if self.options['commandDebounce'] > 0:
+                hub.outbound = CommandScheduler(self.options['commandDebounce']/1000.0, self.options['commandRate'], self.options['commandBufferSize'])
+
+    # Returns the hub owning a connection
+    def getHub(self, Connection):
+        for hub in self.hubs:
+            if hub.mqttClient.mqttConn is Connection:
+                return hub
+        for hub in self.hubs:
+            if hub.name == Connection.Name:
+                return hub
+        return None
+
+    # Returns the hub a device was discovered on
+    def getDeviceHub(self, device):
+        return self.hubsByName.get(device.Options.get('hub'), self.hubs[0])
+
+    # Returns the hub part of a device key for the 'hub' device Option, "" for the primary hub or a hub no longer configured
+    def hubKey(self, name):
+        return name if name in self.hubsByName else ""
+
+    def onStop(self):
+        self.saveSnapshot()
+        if self.profiler.profile != None:
+            self.finishProfile()
+        for hub in self.hubs:
+            if hub.mqttClient != None:
+                hub.mqttClient.Close()
+        if self.mqttClient != None and self.mqttClient.capture != None:
+            self.mqttClient.capture.close()
 
     def onConnect(self, Connection, Status, Description):
-        self.mqttClient.onConnect(Connection, Status, Description)
+        hub = self.getHub(Connection)
+        if hub != None:
+            hub.mqttClient.onConnect(Connection, Status, Description)
+            self.updateHeartbeat()
 
     def onDisconnect(self, Connection):
-        self.mqttClient.onDisconnect(Connection)
+        hub = self.getHub(Connection)
+        if hub != None:
+            hub.mqttClient.onDisconnect(Connection)
 
+    @timed('onMessage')
+    @profiled
     def onMessage(self, Connection, Data):
-        self.mqttClient.onMessage(Connection, Data)
-
-    def onMQTTConnected(self):
-        Domoticz.Debug("onMQTTConnected")
-        self.mqttClient.Subscribe(self.getTopics())
-
-    def onMQTTDisconnected(self):
-        Domoticz.Debug("onMQTTDisconnected")
+        hub = self.getHub(Connection)
+        if hub != None:
+            hub.mqttClient.onMessage(Connection, Data)
+            if hub.outbound != None:
+                self.flushOutbound(hub, time.time())
+            if self.subscriptionsDirty:
+                self.refreshSubscriptions()
+
+    def onMQTTConnected(self, hub):
+        Domoticz.Debug("onMQTTConnected " + hub.name)
+        if not self.updateSubscriptions(hub):
+            # No SUBACK will come to flush the commands queued while disconnected
+            hub.mqttClient.FlushQueue()
+
+    # Brings the subscriptions of a connected hub in line with getTopics, returns True if it subscribed to any topic.
+    # New topics are subscribed to before the others are dropped, so no message is missed in between.
+    def updateSubscriptions(self, hub):
+        client = hub.mqttClient
+        if not client.isConnected:
+            return False
+        wanted = set(self.getTopics(hub))
+        added = sorted(wanted - client.subscriptions)
+        removed = sorted(client.subscriptions - wanted)
+        if added:
+            client.Subscribe(added)
+        if removed:
+            client.Unsubscribe(removed)
+        return len(added) > 0
+
+    def refreshSubscriptions(self):
+        self.subscriptionsDirty = False
+        for hub in self.hubs:
+            self.updateSubscriptions(hub)
+
+    # Opens the discovery window: all remotes are subscribed to for discoveryWindow seconds
+    def startDiscovery(self):
+        if self.options['subscriptionMode'] == "wildcard":
+            Domoticz.Log("Subscribed to all remotes already, new devices are discovered")
+            return
+        if self.options['discoveryWindow'] <= 0:
+            Domoticz.Log("Discovery is off, discoveryWindow is 0")
+            return
+        Domoticz.Log("Discovering new devices for " + str(self.options['discoveryWindow']) + " seconds")
+        self.discoveryUntil = time.time() + self.options['discoveryWindow']
+        self.subscriptionsDirty = True
+
+    def onMQTTDisconnected(self, hub):
+        Domoticz.Debug("onMQTTDisconnected " + hub.name)
+        self.metrics.count('disconnects')
+        self.updateHeartbeat()
+
+    def publish(self, topic, payloadstring, hub=None):
+        if hub == None:
+            hub = self.hubs[0]
+        self.metrics.count('publishes')
+        hub.mqttClient.Publish(topic, payloadstring)
+        if self.options['commandTimeout'] > 0:
+            self.trackCommand(hub, topic, payloadstring)
+
+    # Returns (group 0 topic, topics of all groups) of the remote a group command topic belongs to,
+    # None unless the plugin has a device for every group of that remote (and it has several)
+    def commandGroup(self, hub, topic):
+        match = hub.commandMatcher.match(topic)
+        if match == None or match[3] == '0':
+            return None
+        return self.remoteTopics(hub, match[1], match[2])
+
+    # A group 0 command would switch groups without a device too (e.g. deleted on purpose), so they must all be known
+    def remoteTopics(self, hub, device_id, device_type):
+        members = self.groupMembers.get((hub.key, device_id, device_type))
+        if members == None or len(members) < 2 or len(members) != GROUP_COUNTS.get(device_type, DEFAULT_GROUP_COUNT):
+            return None
+        remote = hub.commands_topic_format.replace(":device_id", device_id).replace(":hex_device_id", device_id).replace(":device_type", device_type)
+        return (remote.replace(":group_id", "0"), tuple(remote.replace(":group_id", self.deviceKeys[u][3]) for u in members))
+
+    # Records a published command as pending against its device, or all group devices for group 0.
+    # A resend of a pending command only refreshes the devices still waiting for it, keeping their attempts.
+    def trackCommand(self, hub, topic, payloadstring):
+        match = hub.commandMatcher.match(topic)
+        if match == None:
+            return
+        keys = [(hub.key,) + match[1:]]
+        if match[3] == '0':
+            members = self.groupMembers.get((hub.key, match[1], match[2]))
+            if members:
+                keys = [self.deviceKeys[u] for u in members]
+        try:
+            status = json.loads(payloadstring).get('status')
+        except (ValueError, AttributeError) as e:
+            status = None
+        now = time.time()
+        waiting = [p for p in (self.pendingCommands.get(key) for key in keys)
+                   if p != None and p.hub is hub and p.topic == topic and p.payloadstring == payloadstring]
+        if waiting:
+            for pending in waiting:
+                pending.sent = now
+            return
+        for key in keys:
+            self.pendingCommands[key] = PendingCommand(hub, topic, payloadstring, status, now)
+
+    # Acknowledges the pending command of a device when its state message agrees with it
+    def ackCommand(self, key, message):
+        pending = self.pendingCommands.get(key)
+        if pending == None or type(message) != dict:
+            return
+        if pending.status != None and message.get('state', pending.status) != pending.status:
+            return
+        del self.pendingCommands[key]
+        self.metrics.count('commands_acked')
+        self.metrics.time('roundtrip ' + pending.hub.name, time.time() - pending.sent)
+
+    # Resends commands whose state did not arrive in time, gives up after the configured retries.
+    # A group 0 command is resent once for all its groups; resends go through the debounce and rate limit.
+    def retryCommands(self, now):
+        timeout = self.options['commandTimeout']
+        resend = dict() # Key=(hub, topic, payloadstring)
+        for key, pending in list(self.pendingCommands.items()):
+            if now - pending.sent < timeout:
+                continue
+            if pending.attempts > self.options['commandRetries']:
+                Domoticz.Log("Command to " + pending.topic + " not acknowledged after " + str(pending.attempts) + " attempts")
+                self.metrics.count('commands_lost')
+                del self.pendingCommands[key]
+                continue
+            pending.sent = now
+            pending.attempts += 1
+            resend[(pending.hub, pending.topic, pending.payloadstring)] = True
+        for (hub, topic, payloadstring) in resend:
+            # A newer command for the topic waits to be sent, it supersedes the resend
+            if hub.outbound != None and topic in hub.outbound.pending:
+                continue
+            pluginLog.debug("Resending command to %s: %s", topic, payloadstring)
+            self.metrics.count('command_retries')
+            self.sendCommand(hub, topic, json.loads(payloadstring), True)
+
+    @timed('onMQTTPublish')
+    def onMQTTPublish(self, topic, rawmessage, hub=None):
+        if hub == None:
+            hub = self.hubs[0]
+        if pluginLog.verbose:
+            pluginLog.mqtt(topic, rawmessage, 'onMQTTPublish: ')
+
+        match = hub.topicMatcher.match(topic)
+        if match is None:
+            self.metrics.count('dropped')
+            return
+        (kind, device_id, device_type, group_id) = match
+        if kind == TOPIC_UPDATES and group_id != '0':
+            self.metrics.count('dropped')
+            return
+        self.metrics.count(kind)
+
+        # Skip byte identical repeats of a state, unless a command waits for it
+        if kind == TOPIC_STATES and hub.payloadCache != None and (hub.key,) + match[1:] not in self.pendingCommands:
+            if hub.payloadCache.seen(topic, rawmessage, time.time()):
+                self.metrics.count('payload_cache_hits')
+                return
+            self.metrics.count('payload_cache_misses')
 
-    def onMQTTPublish(self, topic, rawmessage):
         message = ""
         try:
             message = json.loads(rawmessage.decode('utf8'))
         except ValueError:
             message = rawmessage.decode('utf8')
 
-        topiclist = topic.split('/')
-        if self.debugging == "Verbose" or self.debugging == "Verbose+":
-            DumpMQTTMessageToLog(topic, rawmessage, 'onMQTTPublish: ')
+        if self.inbound != None and type(message) == dict and (kind == TOPIC_STATES or group_id == '0'):
+            now = time.time()
+            self.flushInbound(now)
+            # States and group 0 updates of a remote are merged separately, handle the earlier ones first so they keep their order
+            if kind == TOPIC_UPDATES:
+                for key, merged in self.inbound.release(lambda k: k[0] is hub and k[1][0] == TOPIC_STATES and k[1][1:3] == match[1:3]):
+                    self.dispatchMessage(key[1], merged, key[0])
+            else:
+                update = (TOPIC_UPDATES, device_id, device_type, '0')
+                merged = self.inbound.pop((hub, update))
+                if merged != None:
+                    self.dispatchMessage(update, merged, hub)
+            for key, merged in self.inbound.add((hub, match), message, now):
+                self.dispatchMessage(key[1], merged, key[0])
+            return
+        self.dispatchMessage(match, message, hub)
+
+    # Dispatches merged messages, all of them if now is None
+    def flushInbound(self, now=None):
+        for key, merged in self.inbound.due(now):
+            self.dispatchMessage(key[1], merged, key[0])
+
+    def dispatchMessage(self, match, message, hub):
+        (kind, device_id, device_type, group_id) = match
 
-        states_topic_format_list = self.states_topic_format.split('/')
-        updates_topic_format_list = self.updates_topic_format.split('/')
-        topiclist = topic.split('/')
-        
-        
         #Check states topic
-        if len(states_topic_format_list) == len(topiclist):
-            device_id = None
-            device_type = None
-            group_id = None
-            format_ok = True
-            for i in range(len(topiclist)):
-                item = states_topic_format_list[i]
-                if item==':device_id' or item==':hex_device_id':
-                    device_id = topiclist[i]
-                elif item==':device_type':
-                    device_type = topiclist[i]
-                elif item==':group_id':
-                    group_id = topiclist[i]
-                elif item!=topiclist[i]:
-                    format_ok = False
-                    
-            if format_ok and device_id and device_type and group_id:
-                Domoticz.Debug("Topic: "+topic+" message : "+json.dumps(message))
-                if topic not in self.registeredDevices:
-                    unit = self.setLightDevice(device_id, device_type, group_id, message)
-                    if unit>=0:
-                        self.registeredDevices[topic] = unit
-                self.updateLightDevice(device_id, device_type, group_id, message)
-            
+        if kind == TOPIC_STATES:
+            pluginLog.debug("State: %s/%s/%s message : %s", device_id, device_type, group_id, message)
+            key = (hub.key, device_id, device_type, group_id)
+            if key not in self.deviceIndex:
+                if self.options['discoveryBatchSize'] > 0:
+                    self.queueDiscovery(key, message, hub)
+                    return
+                self.setLightDevice(device_id, device_type, group_id, message, hub)
+            if self.pendingCommands:
+                self.ackCommand(key, message)
+            self.updateLightDevice(device_id, device_type, group_id, message, hub)
+
         #Check updates topic
-        if len(updates_topic_format_list) == len(topiclist):
-            device_id = None
-            device_type = None
-            group_id = None
-            format_ok = True
-            for i in range(len(topiclist)):
-                item = updates_topic_format_list[i]
-                if item==':device_id' or item==':hex_device_id':
-                    device_id = topiclist[i]
-                elif item==':device_type':
-                    device_type = topiclist[i]
-                elif item==':group_id':
-                    group_id = topiclist[i]
-                elif item!=topiclist[i]:
-                    format_ok = False
-                    
-            if format_ok and device_id and device_type and group_id=='0':
-                for i in range(1,8):
-                    single_group_id = str(i)
-                    single_topic = self.states_topic_format.replace(":device_id", device_id).replace(":hex_device_id", device_id).replace(":device_type", device_type).replace(":group_id", single_group_id)
-                    Domoticz.Debug("Topic: "+single_topic)
-                    if single_topic in self.registeredDevices:
-                        Domoticz.Debug("Topic YES: "+single_topic)
-                        self.updateLightDevice(device_id, device_type, single_group_id, message)
-
-    def onMQTTSubscribed(self):
+        elif kind == TOPIC_UPDATES and group_id=='0':
+            for Unit in self.groupMembers.get((hub.key, device_id, device_type), ()):
+                pluginLog.debug("Group update: %s", Unit)
+                self.updateLightUnit(Unit, message)
+                # The group's next state must not be skipped as a repeat
+                self.forgetPayload(hub, self.deviceKeys[Unit])
+            if self.discovery:
+                self.queueGroupUpdate(device_id, device_type, message, hub)
+
+    # Applies a group 0 update to the pending state of the groups of that remote still waiting to be created
+    def queueGroupUpdate(self, device_id, device_type, message, hub):
+        for key, entry in self.discovery.items():
+            if key[0] == hub.key and key[1] == device_id and key[2] == device_type:
+                pluginLog.debug("Group update: queued %s", keyName(key))
+                if type(message) == dict and type(entry[1]) == dict:
+                    entry[1].update(message)
+                else:
+                    entry[1] = message
+
+    # Forgets the last states payload of a device, so the next one is handled even if byte identical
+    def forgetPayload(self, hub, key):
+        if hub.payloadCache != None:
+            (hubKey, device_id, device_type, group_id) = key
+            hub.payloadCache.forget(hub.states_topic_format.replace(":device_id", device_id).replace(":hex_device_id", device_id)
+                                    .replace(":device_type", device_type).replace(":group_id", group_id))
+
+    # Keeps the latest state of a new device until createDiscovered creates it
+    def queueDiscovery(self, key, message, hub):
+        if key[2] not in DEVICE_TYPE_CAPABILITIES:
+            Domoticz.Debug("Unknown device type:'"+key[2]+"'")
+            self.metrics.count('dropped')
+            return
+        entry = self.discovery.get(key)
+        if entry != None:
+            if type(message) == dict and type(entry[1]) == dict:
+                entry[1].update(message)
+            else:
+                entry[1] = message
+            return
+        if key in self.overflowKeys:
+            self.metrics.count('discovery_overflow')
+            return
+        if len(self.discovery) >= len(self.freeUnits):
+            self.reportOverflow(key)
+            return
+        self.discovery[key] = [hub, message]
+        self.metrics.count('discovered')
+        self.updateHeartbeat()
+
+    # Creates up to discoveryBatchSize queued devices and applies their pending state
+    def createDiscovered(self):
+        for _ in range(min(self.options['discoveryBatchSize'], len(self.discovery))):
+            key = next(iter(self.discovery))
+            (hub, message) = self.discovery.pop(key)
+            (hubKey, device_id, device_type, group_id) = key
+            if self.setLightDevice(device_id, device_type, group_id, message, hub) == -1:
+                continue
+            if self.pendingCommands:
+                self.ackCommand(key, message)
+            self.updateLightDevice(device_id, device_type, group_id, message, hub)
+
+    def reportOverflow(self, key):
+        self.metrics.count('discovery_overflow')
+        self.overflowKeys.add(key)
+        # Once per storm, the count of devices not created is in the metrics
+        if len(self.overflowKeys) == 1:
+            Domoticz.Error("Cannot create device " + keyName(key) + " and any further discovered device: all " + str(MAX_UNIT) +
+                           " units of this hardware are in use. Remove unused devices or move remotes to another hub hardware.")
+        else:
+            Domoticz.Debug("Cannot create device " + keyName(key) + ": no free unit, " + str(len(self.overflowKeys)) + " devices not created")
+
+    # Returns the lowest unit without a device, None if all are in use
+    def allocateUnit(self):
+        while self.freeUnits:
+            Unit = heapq.heappop(self.freeUnits)
+            if Unit not in Devices:
+                return Unit
+        return None
+
+    def onMQTTSubscribed(self, hub):
         # (Re)subscribed, refresh device info
-        Domoticz.Debug("onMQTTSubscribed")
+        Domoticz.Debug("onMQTTSubscribed " + hub.name)
         topics = set()
 
 # ==========================================================DASHBOARD COMMAND=============================================================
+    @timed('onCommand')
+    @profiled
     def onCommand(self, Unit, Command, Level, sColor):
         Domoticz.Log(self.deviceStr(Unit) + ": Command: '" + str(Command) + "', Level: " + str(Level) + ", Color:" + str(sColor))
 
-        if Unit in Devices:
+        if Unit in Devices and Devices[Unit].Options.get('control') == '1':
+            self.onControlCommand(Unit, Level)
+        elif Unit in Devices:
             try:
                 device = Devices[Unit]
                 device_id = device.Options['device_id']
                 device_type = device.Options['device_type']
                 group_id = device.Options['group_id']
-                topic = self.commands_topic_format.replace(":device_id", device_id) .replace(":hex_device_id", device_id).replace(":device_type", device_type).replace(":group_id", group_id) 
+                hub = self.getDeviceHub(device)
+                topic = hub.commands_topic_format.replace(":device_id", device_id) .replace(":hex_device_id", device_id).replace(":device_type", device_type).replace(":group_id", group_id) 
                 disco_mode_command = "Disco Mode "
 
-                #Alternate way of increasing/decreasing brightness
-                if Command == "Bright Up":
+                #Alternate way of increasing/decreasing brightness, the hub steps devices without absolute brightness itself
+                if Command == "Bright Up" and device_type in LEVEL_STEP_TYPES:
+                    Command = "Level Up"
+                elif Command == "Bright Down" and device_type in LEVEL_STEP_TYPES:
+                    Command = "Level Down"
+                elif Command == "Bright Up":
                     Command = "Set Brightness"
                     Level = min(device.LastLevel + 5, 100)
                 elif Command == "Bright Down":
@@ -340,7 +1622,7 @@ class BasePlugin:
                     try:
                         color = json.loads(sColor);
                     except (ValueError, KeyError, TypeError) as e:
-                        Domoticz.Error("onCommand: Illegal color: '" + str(sColor) + "'")
+                        pluginLog.error("onCommand: Illegal color: '%s'", sColor)
                         
                     payload['level'] = int(Level)
                     if(Level>0):
@@ -350,7 +1632,7 @@ class BasePlugin:
                         payload['command'] = 'set_white'
                     elif color['m']==2 and 't' in color:
                         payload['command'] = 'set_white'
-                        payload['temperature'] = int(color['t']*100/255)
+                        payload['temperature'] = t_to_temperature(color['t'])
                     elif color['m']==3 and 'r' in color and 'g' in color and 'b' in color:
                         payload['color'] = { 'r': color['r'], 'g': color['g'], 'b': color['b'] }
                 elif Command.startswith(disco_mode_command):
@@ -362,21 +1644,121 @@ class BasePlugin:
                     payload['command'] = 'mode_speed_up'
                 elif Command == "Speed Down":
                     payload['command'] = 'mode_speed_down'
-                #elif Command == "Bright Up":
-                    #payload['command'] = 'level_up'    #Not supported by most devices                  
-                #elif Command == "Bright Down":
-                    #payload['command'] = 'level_down'    #Not supported by most devices
+                elif Command == "Level Up":
+                    payload['command'] = 'level_up'    #Only supported by devices in LEVEL_STEP_TYPES
+                elif Command == "Level Down":
+                    payload['command'] = 'level_down'
                      
                     
                 if payload:
-                    payloadstring = json.dumps(payload)
-                    self.mqttClient.Publish(topic, payloadstring)
+                    self.transitions.pop(Unit, None)
+                    duration = float(device.Options.get('transition', self.options['transitionDuration']))
+                    if duration > 0 and Command in ("Set Brightness", "Set Level", "Set Color"):
+                        self.transition(Unit, hub, topic, payload, duration)
+                    else:
+                        self.sendCommand(hub, topic, payload, Command in ("On", "Off"))
 
             except (ValueError, KeyError, TypeError) as e:
-                Domoticz.Error("onCommand: Error: " + str(e))
+                pluginLog.error("onCommand: Error: %s", e)
         else:
             Domoticz.Debug("Device not found, ignoring command");
 
+    def sendCommand(self, hub, topic, payload, priority=False):
+        if hub.outbound != None:
+            now = time.time()
+            # On/Off for a remote whose groups may all be switched together wait briefly to be collapsed
+            hold = 0
+            if priority and self.options['commandCollapse'] and self.commandGroup(hub, topic) != None:
+                hold = self.options['commandCollapseWindow']/1000.0
+            for t, p in hub.outbound.add(topic, payload, priority, now, hold):
+                self.publish(t, json.dumps(p), hub)
+            self.flushOutbound(hub, now)
+        else:
+            payloadstring = json.dumps(payload)
+            self.publish(topic, payloadstring, hub)
+
+    # Fades a device to the level, color or temperature of a command payload over 'duration' seconds
+    def transition(self, Unit, hub, topic, payload, duration):
+        device_type = self.deviceKeys[Unit][2] if Unit in self.deviceKeys else None
+        if self.options['hubTransitions'] and device_type in HUB_TRANSITION_TYPES:
+            payload = dict(payload)
+            payload['transition'] = duration
+            self.metrics.count('transitions_hub')
+            self.sendCommand(hub, topic, payload)
+            return
+        state = self.shadow.get(Unit)
+        if state == None:
+            state = self.loadShadow(Unit)
+        start = dict()
+        if state.nValue == 0:
+            start['level'] = 0
+        elif str(state.sValue).isdigit():
+            start['level'] = int(state.sValue)
+        if state.t != None:
+            start['temperature'] = t_to_temperature(state.t)
+        if state.r != None and state.g != None and state.b != None:
+            start['color'] = {'r': state.r, 'g': state.g, 'b': state.b}
+        target = {k: v for k, v in payload.items() if k in ('level', 'temperature', 'color')}
+        # Switches the light on, sets white mode etc. along with the first step
+        extra = {k: v for k, v in payload.items() if k not in target}
+        self.transitions[Unit] = Transition(hub, topic, start, target, extra, time.time(), duration, self.options['transitionStepInterval'])
+        self.metrics.count('transitions_stepped')
+        self.updateHeartbeat()
+
+    # Sends the next step of the plugin stepped fades that are due, unless it repeats the previous one
+    def stepTransitions(self, now):
+        interval = self.options['transitionStepInterval']
+        for Unit, fade in list(self.transitions.items()):
+            if now < fade.nextStep:
+                continue
+            (payload, done) = fade.payloadAt(now)
+            fade.nextStep = now + interval
+            if payload != fade.last:
+                fade.last = dict(payload)
+                if fade.extra:
+                    payload.update(fade.extra)
+                    fade.extra = None
+                self.metrics.count('transition_steps')
+                self.sendCommand(fade.hub, fade.topic, payload)
+            if done:
+                del self.transitions[Unit]
+
+    def flushOutbound(self, hub, now):
+        if self.options['commandCollapse'] and len(hub.outbound) > 1:
+            saved = hub.outbound.collapseGroups(now, lambda topic: self.commandGroup(hub, topic))
+            if saved:
+                self.metrics.count('commands_collapsed', saved)
+        for topic, payload in hub.outbound.due(now):
+            self.publish(topic, json.dumps(payload), hub)
+
+    def onControlCommand(self, Unit, Level):
+        action = CONTROL_ACTIONS.get(int(Level))
+        Domoticz.Log("Control action: " + str(action))
+        if action == "Dump log":
+            if pluginLog.ring != None:
+                pluginLog.dump()
+            else:
+                Domoticz.Log("No MQTT messages buffered, set Debug to 'Verbose' to keep them")
+        elif action == "Profile":
+            self.startProfile()
+        elif action == "Discover":
+            self.startDiscovery()
+            self.refreshSubscriptions()
+        Devices[Unit].Update(nValue=0, sValue="0")
+
+    def startProfile(self):
+        Domoticz.Log("Profiling for " + str(self.options['profileWindow']) + " seconds")
+        self.profiler.start(self.options['profileWindow'], time.time())
+
+    # Writes the profile to profile_<HardwareID>_<time>.pstats/.txt in the plugin folder
+    def finishProfile(self):
+        basename = os.path.join(Parameters["HomeFolder"], "profile_" + str(Parameters["HardwareID"]) + "_" + datetime.now().strftime("%Y%m%d_%H%M%S"))
+        try:
+            self.profiler.finish(basename)
+            Domoticz.Log("Profile written to " + basename + ".txt and " + basename + ".pstats")
+        except OSError as e:
+            Domoticz.Error("Failed to write profile " + basename + ": " + str(e))
+
     def onDeviceAdded(self, Unit):
         #Domoticz.Log("onDeviceAdded " + self.deviceStr(Unit))
         return
@@ -384,6 +1766,7 @@ class BasePlugin:
     def onDeviceModified(self, Unit):
         if Unit in Devices:
             device = Devices[Unit]
+            self.indexDevice(Unit)
             try:
                 device_id = device.Options['device_id']
                 device_type = device.Options['device_type']
@@ -391,21 +1774,11 @@ class BasePlugin:
                 Type = device.Type
                 SubType = device.SubType
                 
-                if "@RGBCCT" in Devices[Unit].Name:
-                    Type = 0xf1    # pTypeColorSwitch
-                    SubType = 0x04 # sTypeColor_RGB_CW_WW
-                elif "@CCT" in Devices[Unit].Name:
-                    Type = 0xf1    # pTypeColorSwitch
-                    SubType = 0x08
-                elif "@RGBW" in Devices[Unit].Name:
-                    Type = 0xf1    # pTypeColorSwitch
-                    SubType = 0x01 # sTypeColor_RGB_W
-                elif "@RGB" in Devices[Unit].Name:
-                    Type = 0xf1    # pTypeColorSwitch
-                    SubType = 0x02 # sTypeColor_RGB
-                elif "@DIMMER" in Devices[Unit].Name:
-                    Type = 0xf4        # pTypeGeneralSwitch
-                    SubType = 0x49     # sSwitchGeneralSwitch
+                for tag, capability in NAME_TAG_CAPABILITIES:
+                    if tag in device.Name:
+                        Type = capability.Type
+                        SubType = capability.SubType
+                        break
                     
                 if Type!=device.Type or SubType!=device.SubType:
                     nValue = device.nValue
@@ -413,67 +1786,295 @@ class BasePlugin:
                     Options = device.Options
                     Switchtype = device.SwitchType
                     device.Update(nValue=nValue, sValue=sValue, Type=Type, Subtype=SubType, Switchtype=Switchtype, Options=Options, SuppressTriggers=True)
+                    self.shadow.pop(Unit, None)
                 
             except (ValueError, KeyError, TypeError) as e:
-                Domoticz.Error("onDeviceModified: Error: " + str(e))
+                pluginLog.error("onDeviceModified: Error: %s", e)
+            if self.subscriptionsDirty:
+                self.refreshSubscriptions()
 
     def onDeviceRemoved(self, Unit):
         Domoticz.Log("onDeviceRemoved " + self.deviceStr(Unit))
-        try:
-            for topic,u in registeredDevices:
-                if u==Unit:
-                    registeredDevices[topic] = -1
-        except (ValueError, KeyError, TypeError) as e:
-            pass
+        self.transitions.pop(Unit, None)
+        self.unindexDevice(Unit)
+        if 1 <= Unit <= MAX_UNIT:
+            heapq.heappush(self.freeUnits, Unit)
+            self.overflowKeys.clear() # Let them try again
+        if self.subscriptionsDirty:
+            self.refreshSubscriptions()
 
 
+    @timed('onHeartbeat')
+    @profiled
     def onHeartbeat(self):
-        if self.debugging == "Verbose" or self.debugging == "Verbose+":
+        if pluginLog.verbose:
             Domoticz.Debug("Heartbeating...")
 
-        # Reconnect if connection has dropped
-        if self.mqttClient.mqttConn is None or (not self.mqttClient.mqttConn.Connecting() and not self.mqttClient.mqttConn.Connected() or not self.mqttClient.isConnected):
-            Domoticz.Debug("Reconnecting")
-            self.mqttClient.Open()
-        else:
-            self.mqttClient.Ping()
+        if self.inbound != None:
+            self.flushInbound()
+        for hub in self.hubs:
+            if hub.outbound != None:
+                self.flushOutbound(hub, time.time())
+        if self.pendingCommands:
+            self.retryCommands(time.time())
+        if self.transitions:
+            self.stepTransitions(time.time())
+        if self.discovery:
+            self.createDiscovered()
+
+        now = time.time()
+        for hub in self.hubs:
+            if hub.mqttClient.CheckReconnect(now):
+                self.metrics.count('reconnects')
+        if self.discoveryUntil and now >= self.discoveryUntil:
+            Domoticz.Log("Discovery window closed")
+            self.discoveryUntil = 0
+            self.subscriptionsDirty = True
+        if self.subscriptionsDirty:
+            self.refreshSubscriptions()
+        self.updateHeartbeat()
+
+        if now < self.nextKeepalive:
+            return
+        self.nextKeepalive = now + KEEPALIVE_INTERVAL
+
+        if self.mqttClient.capture != None:
+            self.mqttClient.capture.flush()
+
+        if now >= self.nextMetricsReport:
+            self.nextMetricsReport = now + self.options['metricsInterval']
+            self.reportMetrics()
+
+        if self.snapshotDirty and now >= self.nextSnapshot:
+            self.nextSnapshot = now + self.options['snapshotInterval']
+            self.saveSnapshot()
+
+        # Reconnect if connection has dropped without notice (reconnects after onDisconnect are scheduled by the client)
+        for hub in self.hubs:
+            mqttClient = hub.mqttClient
+            if mqttClient.isConnected and mqttClient.mqttConn != None and mqttClient.mqttConn.Connected():
+                mqttClient.Ping()
+            elif mqttClient.reconnectAt == None and (mqttClient.mqttConn is None or not mqttClient.mqttConn.Connecting()):
+                Domoticz.Debug("Reconnecting " + hub.name)
+                self.metrics.count('reconnects')
+                mqttClient.Open()
+
+    def reportMetrics(self):
+        report = self.options['metricsReport']
+        if report != "none" and (report != "debug" or pluginLog.debugging):
+            summary = "Metrics " + self.metrics.summary()
+            if report == "log":
+                Domoticz.Log(summary)
+            elif report == "device":
+                unit = self.getMetricsDevice()
+                if unit > 0:
+                    Devices[unit].Update(nValue=0, sValue=summary[:255])
+            else:
+                Domoticz.Debug(summary)
+        self.metrics.reset()
+
+    # Returns the unit of the metrics text sensor (created if necessary)
+    def getMetricsDevice(self):
+        return self.getPluginDevice('metrics', "Metrics", "Text", {})
+
+    # Returns the unit of the plugin control selector switch (created if necessary)
+    def getControlDevice(self):
+        levels = sorted(CONTROL_ACTIONS)
+        Options = {'LevelNames':"|".join(["Off"] + [CONTROL_ACTIONS[l] for l in levels]), 'LevelOffHidden':'true', 'SelectorStyle':'1'}
+        Unit = self.getPluginDevice('control', "Control", "Selector Switch", Options)
+        # Devices created by earlier versions lack the newer actions
+        if Unit in Devices and Devices[Unit].Options.get('LevelNames') != Options['LevelNames']:
+            device = Devices[Unit]
+            Options = dict(device.Options, **Options)
+            device.Update(nValue=device.nValue, sValue=device.sValue, Options=Options)
+        return Unit
 
-    # Returns list of topics to subscribe to
-    def getTopics(self):
+    # Returns the unit of a device created by the plugin for itself, marked by an Options key
+    def getPluginDevice(self, marker, Name, TypeName, Options):
+        for k, Device in Devices.items():
+            if Device.Options.get(marker) == '1':
+                return k
+        Options = dict(Options)
+        Options[marker] = '1'
+        iUnit = self.allocateUnit()
+        if iUnit == None:
+            Domoticz.Error("Cannot create " + marker + " device: all " + str(MAX_UNIT) + " units of this hardware are in use")
+            return -1
+        Domoticz.Log("Creating " + marker + " device with unit: " + str(iUnit));
+        Domoticz.Device(Name=Name, Unit=iUnit, TypeName=TypeName, Options=Options, Used=1).Create()
+        if iUnit in Devices:
+            return iUnit
+        return -1
+
+    # Returns list of topics to subscribe to: every remote, or in the narrowed subscription modes
+    # only the remotes of devices on this hub, unless the discovery window is open
+    def getTopics(self, hub):
+        mode = self.options['subscriptionMode']
+        if (mode != "device_id" and mode != "remote") or self.discoveryUntil:
+            remotes = [("+", "+")]
+        else:
+            remotes = set()
+            for key in self.deviceKeys.values():
+                if key[0] == hub.key:
+                    remotes.add((key[1], key[2] if mode == "remote" else "+"))
         topics = set()
-        
-        topic = self.states_topic_format.replace(":device_id", "+") .replace(":hex_device_id", "+") .replace(":device_type", "+").replace(":group_id", "+") 
-        topics.add(topic)
-        topic = self.updates_topic_format.replace(":device_id", "+") .replace(":hex_device_id", "+") .replace(":device_type", "+").replace(":group_id", "+") 
-        topics.add(topic)
+        for device_id, device_type in remotes:
+            topic = hub.states_topic_format.replace(":device_id", device_id) .replace(":hex_device_id", device_id) .replace(":device_type", device_type).replace(":group_id", "+") 
+            topics.add(topic)
+            topic = hub.updates_topic_format.replace(":device_id", device_id) .replace(":hex_device_id", device_id) .replace(":device_type", device_type).replace(":group_id", "+") 
+            topics.add(topic)
         
         Domoticz.Debug("getTopics: '" + str(topics) +"'")
         return list(topics)
 
+    # Returns (hub key, device_id, device_type, group_id) of a device, None if not created by this plugin
+    def deviceKey(self, device):
+        return self.optionsKey(device.Options)
+
+    def optionsKey(self, Options):
+        try:
+            return (self.hubKey(Options.get('hub')), Options['device_id'], Options['device_type'], Options['group_id'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return None
+
+    # Builds the device index, trusting the snapshot for devices whose type is unchanged.
+    # Other devices are indexed from their Options, their shadow is loaded on first update.
+    def buildDeviceIndex(self, snapshot=None):
+        self.deviceIndex = dict()
+        self.deviceKeys = dict()
+        self.groupMembers = dict()
+        self.shadow = dict()
+        known = set()
+        if snapshot != None:
+            for entry in snapshot:
+                try:
+                    (Unit, key, Type, SubType, nValue, sValue, Color, state) = entry
+                    device = Devices.get(Unit)
+                    if device == None or device.Type != Type or device.SubType != SubType:
+                        continue
+                    known.add(Unit)
+                    if key == None:
+                        continue
+                    # The hub may have been removed from the options since
+                    (hubName, device_id, device_type, group_id) = key
+                    key = (self.hubKey(hubName), device_id, device_type, group_id)
+                    if key not in self.deviceIndex:
+                        self.addToIndex(key, Unit)
+                    if state != None and device.nValue == nValue and device.sValue == sValue and device.Color == Color:
+                        self.shadow[Unit] = LightState.fromList(state, nValue, sValue, capabilityOf(Type, SubType))
+                except (ValueError, KeyError, TypeError) as e:
+                    Domoticz.Debug("buildDeviceIndex: Ignoring snapshot entry " + str(entry) + ": " + str(e))
+        for k in Devices:
+            if k not in known:
+                self.indexDevice(k)
+        self.snapshotDirty = len(known) != len(Devices)
+        self.freeUnits = [u for u in range(1, MAX_UNIT + 1) if u not in Devices] # Sorted, so already a heap
+        Domoticz.Debug("buildDeviceIndex: " + str(len(self.deviceIndex)) + " devices indexed, " + str(len(known)) + " from snapshot, " + str(len(self.shadow)) + " states restored")
+
+    def snapshotPath(self):
+        return os.path.join(Parameters["HomeFolder"], "snapshot_" + str(Parameters["HardwareID"]) + ".json")
+
+    # Returns the snapshot entries saved by saveSnapshot, None if there is no usable snapshot
+    def loadSnapshot(self):
+        if self.options['snapshotInterval'] <= 0:
+            return None
+        try:
+            with open(self.snapshotPath(), 'r') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') == SNAPSHOT_VERSION:
+                return snapshot['devices']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            Domoticz.Log("loadSnapshot: Ignoring " + self.snapshotPath() + ": " + str(e))
+        return None
+
+    # Saves the device registry: unit, key, type and last known decoded state of every device
+    def saveSnapshot(self):
+        if self.options['snapshotInterval'] <= 0:
+            return
+        devices = []
+        for Unit, device in Devices.items():
+            state = self.shadow.get(Unit)
+            if state != None and (state.nValue != device.nValue or state.sValue != device.sValue):
+                state = None
+            devices.append([Unit, self.deviceKeys.get(Unit), device.Type, device.SubType, device.nValue, device.sValue, device.Color, state.toList() if state != None else None])
+        path = self.snapshotPath()
+        try:
+            with open(path + ".tmp", 'w') as f:
+                json.dump({'version': SNAPSHOT_VERSION, 'devices': devices}, f, separators=(',', ':'))
+            os.replace(path + ".tmp", path)
+            self.snapshotDirty = False
+        except OSError as e:
+            Domoticz.Error("saveSnapshot: Failed to write " + path + ": " + str(e))
+
+    def indexDevice(self, Unit):
+        self.unindexDevice(Unit)
+        key = self.deviceKey(Devices[Unit])
+        if key != None and key not in self.deviceIndex:
+            self.addToIndex(key, Unit)
+
+    def unindexDevice(self, Unit):
+        self.shadow.pop(Unit, None)
+        key = self.deviceKeys.get(Unit)
+        if key != None and self.deviceIndex.get(key) == Unit:
+            self.removeFromIndex(key, Unit)
+            # Promote a duplicate device with the same key, if any
+            for k, Device in Devices.items():
+                if k != Unit and k not in self.deviceKeys and self.deviceKey(Device) == key:
+                    self.addToIndex(key, k)
+                    break
+
+    def addToIndex(self, key, Unit):
+        self.snapshotDirty = True
+        self.subscriptionsDirty = True
+        self.deviceIndex[key] = Unit
+        self.deviceKeys[Unit] = key
+        (hubKey, device_id, device_type, group_id) = key
+        if group_id.isdigit() and 1 <= int(group_id) <= GROUP_COUNTS.get(device_type, DEFAULT_GROUP_COUNT):
+            members = self.groupMembers.setdefault(key[:3], [])
+            members.append(Unit)
+            members.sort(key=lambda u: int(self.deviceKeys[u][3]))
+
+    def removeFromIndex(self, key, Unit):
+        self.snapshotDirty = True
+        self.subscriptionsDirty = True
+        # A device removed and discovered again must not miss its state as a repeat
+        self.forgetPayload(self.hubsByName.get(key[0], self.hubs[0]), key)
+        del self.deviceIndex[key]
+        del self.deviceKeys[Unit]
+        members = self.groupMembers.get(key[:3])
+        if members != None and Unit in members:
+            members.remove(Unit)
+            if not members:
+                del self.groupMembers[key[:3]]
+
     # Returns list of matching devices
-    def getDevices(self, device_id, device_type, group_id):
-        if self.debugging == "Verbose" or self.debugging == "Verbose+":
-            Domoticz.Debug("getDevices device_id: '" + device_id + "' device_type: '" + device_type + "' group_id: '" + group_id + "'")
-        matchingDevices = set()
-        for k, Device in Devices.items():
-            try:
-                if Device.Options['device_id'] == device_id and Device.Options['device_type'] == device_type and Device.Options['group_id'] == group_id:
-                    matchingDevices.add(k)
-            except (ValueError, KeyError) as e:
-                pass
-        if self.debugging == "Verbose" or self.debugging == "Verbose+":
-            Domoticz.Debug("getDevices found " + str(len(matchingDevices)) + " devices")
-        return list(matchingDevices)
+    def getDevices(self, device_id, device_type, group_id, hub=None):
+        Unit = self.deviceIndex.get((hub.key if hub != None else "", device_id, device_type, group_id))
+        if Unit == None:
+            return []
+        return [Unit]
 
     def makeDevice(self, Name, Options, TypeName, switchTypeDomoticz, data):
-        iUnit = next(filterfalse(set(Devices).__contains__, count(1))) # First unused 'Unit'
+        iUnit = self.allocateUnit()
+        if iUnit == None:
+            self.reportOverflow(self.optionsKey(Options))
+            return
         Domoticz.Log("Creating device with unit: " + str(iUnit));
         Domoticz.Device(Name=Name, Unit=iUnit, TypeName=TypeName, Switchtype=switchTypeDomoticz, Options=Options, Used=self.options['addDiscoveredDeviceUsed']).Create()
+        if iUnit in Devices:
+            self.indexDevice(iUnit)
 
     def makeDeviceRaw(self, Name, Options, Type, Subtype, switchTypeDomoticz, data):
-        iUnit = next(filterfalse(set(Devices).__contains__, count(1))) # First unused 'Unit'
+        iUnit = self.allocateUnit()
+        if iUnit == None:
+            self.reportOverflow(self.optionsKey(Options))
+            return
         Domoticz.Log("Creating device with unit: " + str(iUnit));
         Domoticz.Device(Name=Name, Unit=iUnit, Type=Type, Subtype=Subtype, Switchtype=switchTypeDomoticz, Options=Options, Used=self.options['addDiscoveredDeviceUsed']).Create()
+        if iUnit in Devices:
+            self.indexDevice(iUnit)
 
 
 
@@ -482,193 +2083,113 @@ class BasePlugin:
 # =============================================================DEVICE CONFIG==============================================================
     
     # Returns the device unit corresponding to this topic (created if necessary)
-    def setLightDevice(self, device_id, device_type, group_id, message):
-        Domoticz.Debug("setLightDevice device_id:"+device_id+" Type:"+device_type+" Group:"+group_id + " Message:"+json.dumps(message))
+    def setLightDevice(self, device_id, device_type, group_id, message, hub=None):
+        pluginLog.debug("setLightDevice device_id:%s Type:%s Group:%s Message:%s", device_id, device_type, group_id, message)
 
         TypeName = ''
-        Type = 0
-        Subtype = 0
-        switchTypeDomoticz = 0 # OnOff
-        hasCCT = False
-        hasRGB = False
-        
-        if device_type == 'fut089' or device_type == 'rgb_cct':
-            Domoticz.Debug("devicetype == RGBCCT")
-            switchTypeDomoticz = 7 # Dimmer
-            Type = 0xf1    # pTypeColorSwitch
-            Subtype = 0x04 # sTypeColor_RGB_CW_WW
-        elif device_type == 'cct' or device_type == 'fut091':
-            Domoticz.Debug("devicetype == CCT")
-            switchTypeDomoticz = 7 # Dimmer
-            Type = 0xf1    # pTypeColorSwitch
-            Subtype = 0x08
-        elif device_type == 'rgbw':
-            Domoticz.Debug("devicetype == RGBW")
-            switchTypeDomoticz = 7 # Dimmer
-            Type = 0xf1    # pTypeColorSwitch
-            Subtype = 0x01 # sTypeColor_RGB_W
-        elif device_type == 'rgb':
-            Domoticz.Debug("devicetype == RGB")
-            switchTypeDomoticz = 7 # Dimmer
-            Type = 0xf1    # pTypeColorSwitch
-            Subtype = 0x02 # sTypeColor_RGB
-        # elif device_type == '':  # Currently we do not know how to identify dimmer only devices
-            # Domoticz.Debug("devicetype == 'switch'")
-            # TypeName = 'Switch'
-            # Type = 0xf4        # pTypeGeneralSwitch
-            # Subtype = 0x49     # sSwitchGeneralSwitch
-        else:
+        capability = DEVICE_TYPE_CAPABILITIES.get(device_type)
+        if capability == None:
             Domoticz.Debug("Unknown device type:'"+device_type+"'")
             return -1
-
-        matchingDevices = self.getDevices(device_id, device_type, group_id)
-        if len(matchingDevices) == 0:
+        Domoticz.Debug("devicetype == " + capability.name)
+        Type = capability.Type
+        Subtype = capability.SubType
+        switchTypeDomoticz = capability.Switchtype
+
+        if hub == None:
+            hub = self.hubs[0]
+        key = (hub.key, device_id, device_type, group_id)
+        Unit = self.deviceIndex.get(key)
+        if Unit == None:
             # Device not existing
             Domoticz.Log("setLightDevice: Did not find device with device_id:"+device_id+" Type:"+device_type+" Group:"+group_id)
             Domoticz.Log("setLightDevice: TypeName: '" + TypeName + "' Type: " + str(Type)+ " Subtype: " + str(Subtype))
             Options = {'device_id':device_id, 'device_type':device_type, 'group_id':group_id}
+            if hub is not self.hubs[0]:
+                Options['hub'] = hub.name
             Name = str(device_id)+'/'+str(device_type)+'/'+str(group_id)
             if TypeName != '':
                 self.makeDevice(Name, Options, TypeName, switchTypeDomoticz, message)
-                matchingDevices = self.getDevices(device_id, device_type, group_id)
             elif Type != 0:
                 self.makeDeviceRaw(Name, Options, Type, Subtype, switchTypeDomoticz, message)
-                matchingDevices = self.getDevices(device_id, device_type, group_id)
+            Unit = self.deviceIndex.get(key)
             
-        if len(matchingDevices) > 0:
-            u = matchingDevices[0]
-            return u
+        if Unit != None:
+            return Unit
         else:
             return -1
             
     def hs_to_rgb(self, h, s):
-        if s == 0: return (255, 255, 255)
-        i = int(h*6.0/360) # XXX assume int() truncates!
-        f = (h*6.0/360)-i
-        p = 255*(1.0-s/100)
-        q = int(255*(1.0-s/100*f))
-        t = int(255*(1.0-s/100*(1.0-f)))
-        i%=6
-        if i == 0: return (255, t, p)
-        if i == 1: return (q, 255, p)
-        if i == 2: return (p, 255, t)
-        if i == 3: return (p, q, 255)
-        if i == 4: return (t, p, 255)
-        if i == 5: return (255, p, q)
-        
+        return hs_to_rgb(h, s)
+
     def rgb_to_hs(self,r,g,b):
-        cmin = min(r,g,b)
-        cmax = max(r,g,b)
-        delta = cmax - cmin
-        hue = 0
-        sat = 0
-        if delta>0:
-            if r==cmax:
-                hue = int((g-b)*60/delta)
-            elif g==cmax:
-                hue = int(120 + (b-r)*60/delta)
-            else:
-                hue = int(240 + (r-g)*60/delta)
-            if hue<0:
-                hue = hue+360
-            elif hue>360:
-                hue = hue-360
-            
-            if cmax>0:
-                sat = int(delta/cmax*100)
-        
-        return (hue, sat)
+        return rgb_to_hs(r, g, b)
 
 # ==========================================================UPDATE STATUS from MQTT==============================================================
-    def updateLightDevice(self, device_id, device_type, group_id, message):
-        matchingDevices = self.getDevices(device_id, device_type, group_id)
-        if len(matchingDevices) > 0:
-            Unit = matchingDevices[0]
-            Domoticz.Log(self.deviceStr(Unit) + ": State change: '" + str(message))
-            device = Devices[Unit]
-            nValue = device.nValue
-            sValue = device.sValue
-
-            hasCCT = False
-            hasRGB = False
-            if device.Type==0xf1:
-                if device.SubType == 0x04:
-                    hasCCT = True
-                    hasRGB = True
-                if device.SubType == 0x08:
-                    hasCCT = True
-                if device.SubType == 0x01:
-                    hasCCT = True
-                    hasRGB = True
-                if device.SubType == 0x02:
-                    hasCCT = True
-                    hasRGB = True
-                
-            try:
-                Color = json.loads(device.Color);
-            except (ValueError, KeyError, TypeError) as e:
-                Color = dict()
-                pass
+    def updateLightDevice(self, device_id, device_type, group_id, message, hub=None):
+        Unit = self.deviceIndex.get((hub.key if hub != None else "", device_id, device_type, group_id))
+        if Unit != None:
+            self.updateLightUnit(Unit, message)
 
-            hue = 0
-            sat = 0
-            if 'r' in Color and 'g' in Color and 'b' in Color:
-                (hue, sat) = self.rgb_to_hs(Color['r'],Color['g'],Color['b'])
-                
-            if 'state' in message:
-                if message['state']=='ON':
-                    nValue = 1
-                elif message['state']=='OFF':
-                    nValue = 0
-
-            if 'brightness' in message:
-                sValue = str(int(message['brightness']*100/255))
-                    
-            if 'bulb_mode' in message:
-                if message['bulb_mode']=='white':
-                    if hasCCT:
-                        Color['m'] = 2
-                    else:
-                        Color['m'] = 1
-                elif (message['bulb_mode']=='rgb' or message['bulb_mode']=='color') and hasRGB:
-                    Color['m'] = 3
-                elif message['bulb_mode']=='scene' and 'mode' in message:
-                    nValue = 24+message['mode']
-                    sValue = "Disco Mode "+str(message['mode']+1)
-
-            if 'color_temp' in message and hasCCT:
-                Color['t'] = int(int(message['color_temp'])-153)*255/(370-153)
-                   
-            if 'hue' in message and hasRGB:
-                hue = message['hue']
-                (r,g,b) = self.hs_to_rgb(hue,sat)
-                Color['r'] = r
-                Color['g'] = g
-                Color['b'] = b
-
-            if 'saturation' in message and hasRGB:
-                sat = message['saturation']
-                (r,g,b) = self.hs_to_rgb(hue, sat)
-                Color['r'] = r
-                Color['g'] = g
-                Color['b'] = b
-
-            if 'color' in message and hasRGB:
-                col = message['color']
-                if 'r' in col:
-                    Color['r'] = col['r']
-                if 'g' in col:
-                    Color['g'] = col['g']
-                if 'b' in col:
-                    Color['b'] = col['b']
-  
+    @timed('updateLightDevice')
+    def updateLightUnit(self, Unit, message):
+        if Unit in Devices:
+            state = self.shadow.get(Unit)
+            if state == None:
+                state = self.loadShadow(Unit)
+            pluginLog.stateChange(Unit, Devices[Unit].Name, message)
+            new = state.copy()
+            state.capability.apply(new, message)
+
+            now = time.time()
+            forceInterval = self.options['forceUpdateInterval']
+            forced = forceInterval > 0 and now - state.lastUpdate >= forceInterval
+            if not forced and new.nValue == state.nValue and new.sValue == state.sValue and sameLevel(new.m, state.m) and sameLevel(new.t, state.t) and \
+                    sameLevel(new.r, state.r) and sameLevel(new.g, state.g) and sameLevel(new.b, state.b):
+                # Nothing to write to Domoticz, but keep hue and saturation as received for later partial messages
+                self.shadow[Unit] = new
+                self.metrics.count('suppressed')
+                return
+            self.metrics.count('domoticz_updates')
+            new.lastUpdate = now
+            self.shadow[Unit] = new
+            self.snapshotDirty = True
+
+            Color = new.color()
             if Color:
                 Color=json.dumps(Color)
-                Domoticz.Debug("Update Color : "+Color)
-                device.Update(nValue=nValue, sValue=sValue, Color=Color)
+                pluginLog.debug("Update Color : %s", Color)
+                Devices[Unit].Update(nValue=new.nValue, sValue=new.sValue, Color=Color)
             else:
-                device.Update(nValue=nValue, sValue=sValue)
-            
+                Devices[Unit].Update(nValue=new.nValue, sValue=new.sValue)
+
+    # Decodes the current state of a device into its shadow record
+    def loadShadow(self, Unit):
+        device = Devices[Unit]
+        state = LightState()
+        state.nValue = device.nValue
+        state.sValue = device.sValue
+        try:
+            Color = json.loads(device.Color)
+        except (ValueError, KeyError, TypeError) as e:
+            Color = dict()
+        if type(Color) != dict:
+            Color = dict()
+        state.m = Color.get('m')
+        state.t = Color.get('t')
+        state.r = Color.get('r')
+        state.g = Color.get('g')
+        state.b = Color.get('b')
+        state.cw = Color.get('cw')
+        state.ww = Color.get('ww')
+        state.hue = 0
+        state.sat = 0
+        if state.r != None and state.g != None and state.b != None:
+            (state.hue, state.sat) = self.rgb_to_hs(state.r, state.g, state.b)
+        state.capability = capabilityOf(device.Type, device.SubType)
+        state.lastUpdate = 0
+        self.shadow[Unit] = state
+        return state
 
 
 
@@ -679,6 +2200,10 @@ def onStart():
     global _plugin
     _plugin.onStart()
 
+def onStop():
+    global _plugin
+    _plugin.onStop()
+
 def onConnect(Connection, Status, Description):
     global _plugin
     _plugin.onConnect(Connection, Status, Description)
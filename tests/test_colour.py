@@ -0,0 +1,122 @@
+#           Colour conversion tables and batches against the original formulas
+#
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Domoticz
+import plugin
+
+# The conversions as BasePlugin and onCommand computed them before the tables
+def old_hs_to_rgb(h, s):
+    if s == 0: return (255, 255, 255)
+    i = int(h*6.0/360)
+    f = (h*6.0/360)-i
+    p = 255*(1.0-s/100)
+    q = int(255*(1.0-s/100*f))
+    t = int(255*(1.0-s/100*(1.0-f)))
+    i%=6
+    if i == 0: return (255, t, p)
+    if i == 1: return (q, 255, p)
+    if i == 2: return (p, 255, t)
+    if i == 3: return (p, q, 255)
+    if i == 4: return (t, p, 255)
+    if i == 5: return (255, p, q)
+
+def old_rgb_to_hs(r, g, b):
+    cmin = min(r,g,b)
+    cmax = max(r,g,b)
+    delta = cmax - cmin
+    hue = 0
+    sat = 0
+    if delta>0:
+        if r==cmax:
+            hue = int((g-b)*60/delta)
+        elif g==cmax:
+            hue = int(120 + (b-r)*60/delta)
+        else:
+            hue = int(240 + (r-g)*60/delta)
+        if hue<0:
+            hue = hue+360
+        elif hue>360:
+            hue = hue-360
+        if cmax>0:
+            sat = int(delta/cmax*100)
+    return (hue, sat)
+
+def old_mired_to_t(color_temp):
+    return int(int(color_temp)-153)*255/(370-153)
+
+def old_t_to_temperature(t):
+    return int(t*100/255)
+
+def random_rgb(rnd, n):
+    return [(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for i in range(n)]
+
+ALL_HS = [(h, s) for h in range(361) for s in range(101)]
+
+
+class ColourTableTest(unittest.TestCase):
+    def test_hs_to_rgb(self):
+        for h, s in ALL_HS:
+            self.assertEqual(plugin.hs_to_rgb(h, s), old_hs_to_rgb(h, s), (h, s))
+        # Filled entries are returned on the next call, values outside the table are computed
+        self.assertEqual(plugin.hs_to_rgb(200, 50), old_hs_to_rgb(200, 50))
+        for h, s in [(12.5, 40), (-10, 50), (400, 50), (120, 101.5)]:
+            self.assertEqual(plugin.hs_to_rgb(h, s), old_hs_to_rgb(h, s), (h, s))
+
+    def test_rgb_to_hs(self):
+        for r, g, b in random_rgb(random.Random(1), 20000) + [(0, 0, 0), (255, 255, 255), (255, 0, 0), (0, 255, 0), (0, 0, 255)]:
+            self.assertEqual(plugin.rgb_to_hs(r, g, b), old_rgb_to_hs(r, g, b), (r, g, b))
+
+    def test_mired_to_t(self):
+        for m in range(100, 501):
+            self.assertEqual(plugin.mired_to_t(m), old_mired_to_t(m), m)
+            self.assertEqual(plugin.mired_to_t(str(m)), old_mired_to_t(str(m)), m)
+
+    def test_t_to_temperature(self):
+        for t in list(range(256)) + [-1, 256, 127.5]:
+            self.assertEqual(plugin.t_to_temperature(t), old_t_to_temperature(t), t)
+
+    def test_t_to_mired(self):
+        for t in list(range(256)) + [127.5]:
+            self.assertEqual(plugin.t_to_mired(t), plugin.MIRED_MIN + t*(plugin.MIRED_MAX-plugin.MIRED_MIN)/255, t)
+
+    def test_round_trip(self):
+        # Hub color_temp -> Domoticz 't' -> hub color_temp stays within one mired
+        for m in range(plugin.MIRED_MIN, plugin.MIRED_MAX + 1):
+            self.assertAlmostEqual(plugin.t_to_mired(plugin.mired_to_t(m)), m, delta=1)
+        # Saturated colours come back with their hue within the rounding of the conversion
+        for h in range(360):
+            (r, g, b) = plugin.hs_to_rgb(h, 100)
+            (hue, sat) = plugin.rgb_to_hs(r, g, b)
+            self.assertEqual(sat, 100)
+            self.assertLessEqual(min(abs(hue - h), 360 - abs(hue - h)), 1, h)
+
+
+class ColourBatchTest(unittest.TestCase):
+    def check_batches(self, use_numpy):
+        rnd = random.Random(2)
+        hs = ALL_HS + [(rnd.randrange(361), rnd.randrange(101)) for i in range(1000)]
+        self.assertEqual(plugin.hs_to_rgb_batch(hs, use_numpy), [old_hs_to_rgb(h, s) for h, s in hs])
+        rgb = random_rgb(rnd, 20000) + [(0, 0, 0), (255, 255, 255), (10, 10, 10)]
+        self.assertEqual(plugin.rgb_to_hs_batch(rgb, use_numpy), [old_rgb_to_hs(r, g, b) for r, g, b in rgb])
+
+    def test_tables(self):
+        self.check_batches(False)
+
+    @unittest.skipUnless(plugin.get_numpy(), "NumPy is not installed")
+    def test_numpy(self):
+        self.check_batches(True)
+
+    def test_default(self):
+        # Small batches never take the NumPy path
+        self.assertEqual(plugin.hs_to_rgb_batch([(100, 50)]), [old_hs_to_rgb(100, 50)])
+        self.assertEqual(plugin.rgb_to_hs_batch([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
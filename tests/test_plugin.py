@@ -0,0 +1,168 @@
+#           Plugin behaviour against the Domoticz stand-in
+#
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Domoticz
+import plugin
+
+
+class PluginTest(unittest.TestCase):
+    """Runs a fresh plugin instance connected to a stand-in MQTT connection."""
+    options = {}
+
+    def setUp(self):
+        importlib.reload(plugin)
+        options = {"metricsReport":"none", "snapshotInterval":0, "discoveryBatchSize":0}
+        options.update(self.options)
+        Domoticz.install(plugin, {"Mode5":json.dumps(options)})
+        plugin.onStart()
+        self.conn = Domoticz.connections[-1]
+        self.conn.accept(plugin)
+
+    def tearDown(self):
+        plugin.onStop()
+
+    def receive(self, topic, message):
+        plugin.onMessage(self.conn, {'Verb':'PUBLISH', 'Topic':topic, 'Payload':json.dumps(message).encode()})
+
+    def state(self, device_id, device_type, group_id, message):
+        self.receive("milight/states/" + device_id + "/" + device_type + "/" + group_id, message)
+
+    def unit(self, device_id, device_type, group_id, hub=""):
+        return plugin._plugin.deviceIndex[(hub, device_id, device_type, group_id)]
+
+    # Returns [(topic, payload dict)] published since 'start', the index into conn.sent
+    def published(self, start=0):
+        return [(m['Topic'], json.loads(bytes(m['Payload']))) for m in self.conn.sent[start:] if m['Verb'] == 'PUBLISH']
+
+
+class CommandCollapseTest(PluginTest):
+    options = {"commandDebounce":200, "commandCollapseWindow":100}
+
+    def test_on_for_every_group_is_one_group_0_command(self):
+        for g in "1234":
+            self.state("0x1", "rgb_cct", g, {"state":"OFF"})
+        start = len(self.conn.sent)
+        for g in "1234":
+            plugin.onCommand(self.unit("0x1", "rgb_cct", g), "On", 0, "")
+        self.assertEqual(self.published(start), [("milight/0x1/rgb_cct/0", {"status":"ON"})])
+
+    def test_single_on_waits_for_the_collapse_window_only(self):
+        for g in "1234":
+            self.state("0x1", "rgb_cct", g, {"state":"OFF"})
+        start = len(self.conn.sent)
+        plugin.onCommand(self.unit("0x1", "rgb_cct", "1"), "On", 0, "")
+        self.assertEqual(self.published(start), [])
+        time.sleep(0.11)
+        plugin.onHeartbeat()
+        self.assertEqual(self.published(start), [("milight/0x1/rgb_cct/1", {"status":"ON"})])
+
+    def test_remote_with_groups_missing_is_not_collapsed(self):
+        # Group 4 has no device, a group 0 command would switch it too
+        for g in "123":
+            self.state("0x1", "rgb_cct", g, {"state":"OFF"})
+        start = len(self.conn.sent)
+        for g in "123":
+            plugin.onCommand(self.unit("0x1", "rgb_cct", g), "On", 0, "")
+        self.assertEqual(self.published(start), [("milight/0x1/rgb_cct/" + g, {"status":"ON"}) for g in "123"])
+
+
+class CoalesceOrderTest(PluginTest):
+    options = {"coalesceWindow":200}
+
+    def test_states_and_group_updates_keep_their_order(self):
+        for g in "1234":
+            self.state("0x1", "rgb_cct", g, {"state":"OFF"})
+        plugin._plugin.flushInbound()
+        self.state("0x1", "rgb_cct", "1", {"state":"ON"})
+        self.receive("milight/updates/0x1/rgb_cct/0", {"state":"OFF"})
+        self.state("0x1", "rgb_cct", "1", {"state":"OFF"})
+        self.state("0x1", "rgb_cct", "1", {"state":"ON"})
+        plugin._plugin.flushInbound()
+        # The hub's last word on group 1 was ON, the update switched the others off
+        self.assertEqual(Domoticz.Devices[self.unit("0x1", "rgb_cct", "1")].nValue, 1)
+        for g in "234":
+            self.assertEqual(Domoticz.Devices[self.unit("0x1", "rgb_cct", g)].nValue, 0)
+
+    def test_group_update_after_pending_states(self):
+        for g in "12":
+            self.state("0x1", "cct", g, {"state":"OFF"})
+        plugin._plugin.flushInbound()
+        self.state("0x1", "cct", "2", {"state":"ON"})
+        self.receive("milight/updates/0x1/cct/0", {"state":"OFF"})
+        plugin._plugin.flushInbound()
+        self.assertEqual(Domoticz.Devices[self.unit("0x1", "cct", "2")].nValue, 0)
+
+
+GARAGE = {"name":"garage", "commands":"garage/:device_id/:device_type/:group_id",
+          "states":"garage/states/:device_id/:device_type/:group_id", "updates":"garage/updates/:device_id/:device_type/:group_id"}
+
+class MultiHubTest(PluginTest):
+    options = {"hubs":[GARAGE]}
+
+    def setUp(self):
+        PluginTest.setUp(self)
+        self.garage = self.conn
+        self.conn = Domoticz.connections[0]
+        self.conn.accept(plugin)
+
+    def test_same_remote_on_two_hubs_is_two_devices(self):
+        plugin.onMessage(self.garage, {'Verb':'PUBLISH', 'Topic':"garage/states/0x1/rgb_cct/1", 'Payload':b'{"state":"ON"}'})
+        self.state("0x1", "rgb_cct", "1", {"state":"OFF"})
+        garage = self.unit("0x1", "rgb_cct", "1", "garage")
+        primary = self.unit("0x1", "rgb_cct", "1")
+        self.assertNotEqual(garage, primary)
+        self.assertEqual(Domoticz.Devices[garage].nValue, 1)
+        self.assertEqual(Domoticz.Devices[primary].nValue, 0)
+        start = (len(self.conn.sent), len(self.garage.sent))
+        plugin.onCommand(primary, "On", 0, "")
+        plugin.onCommand(garage, "Off", 0, "")
+        self.assertEqual(self.published(start[0]), [("milight/0x1/rgb_cct/1", {"status":"ON"})])
+        self.assertEqual([(m['Topic'], json.loads(bytes(m['Payload']))) for m in self.garage.sent[start[1]:] if m['Verb'] == 'PUBLISH'],
+                         [("garage/0x1/rgb_cct/1", {"status":"OFF"})])
+
+    def test_snapshot_keeps_the_hub(self):
+        plugin.onMessage(self.garage, {'Verb':'PUBLISH', 'Topic':"garage/states/0x1/cct/1", 'Payload':b'{"state":"ON"}'})
+        self.state("0x1", "cct", "1", {"state":"OFF"})
+        with tempfile.TemporaryDirectory() as home:
+            Domoticz.Parameters["HomeFolder"] = home + os.sep
+            plugin._plugin.options['snapshotInterval'] = 300
+            plugin._plugin.saveSnapshot()
+            keys = dict(plugin._plugin.deviceKeys)
+            plugin._plugin.buildDeviceIndex(plugin._plugin.loadSnapshot())
+        self.assertEqual(plugin._plugin.deviceKeys, keys)
+        self.assertEqual(sorted(keys.values()), [("", "0x1", "cct", "1"), ("garage", "0x1", "cct", "1")])
+
+
+class CaptureTest(unittest.TestCase):
+    def test_records_keep_the_hub(self):
+        with tempfile.TemporaryDirectory() as home:
+            filename = os.path.join(home, "capture.bin")
+            capture = plugin.MqttCapture(filename, 0)
+            capture.write("garage", "garage/states/0x1/cct/1", b'{"state":"ON"}')
+            capture.close()
+            capture = plugin.MqttCapture(filename, 0)
+            capture.write("127.0.0.1", "milight/states/0x1/cct/1", b'{}')
+            capture.close()
+            records = [r[1:] for r in plugin.MqttCapture.read(filename)]
+        self.assertEqual(records, [("garage", "garage/states/0x1/cct/1", b'{"state":"ON"}'), ("127.0.0.1", "milight/states/0x1/cct/1", b'{}')])
+
+    def test_earlier_format_is_read_but_not_appended_to(self):
+        with tempfile.TemporaryDirectory() as home:
+            filename = os.path.join(home, "capture.bin")
+            with open(filename, 'wb') as f:
+                f.write(plugin.MqttCapture.oldHeader.pack(1.0, 3, 2) + b'a/b' + b'{}')
+            self.assertEqual(list(plugin.MqttCapture.read(filename)), [(1.0, "", "a/b", b'{}')])
+            self.assertRaises(IOError, plugin.MqttCapture, filename, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
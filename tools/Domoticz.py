@@ -0,0 +1,181 @@
+#           Stand-in for the Domoticz plugin framework module
+#
+"""Minimal stand-in for the 'Domoticz' module provided by the plugin framework.
+
+Lets plugin.py run outside Domoticz (benchmarks, replay, simulation). Calls are
+counted in 'counts', recent log lines are kept in 'messages' and every
+Connection keeps the messages it was asked to send in 'sent'.
+
+Usage:
+    import Domoticz
+    import plugin
+    Domoticz.install(plugin, {"Mode3": ...})
+    plugin.onStart()
+"""
+from collections import Counter, deque
+import json
+
+Devices = dict()
+Parameters = dict()
+counts = Counter()
+messages = deque(maxlen=1000)
+connections = []
+heartbeat = 10
+debugging = 0
+MAX_UNIT = 255 # Domoticz limit, benchmarks may raise it
+
+DEFAULT_PARAMETERS = {"Key":"MilightESP8266", "HardwareID":1, "HomeFolder":"./", "Name":"Milight", "Address":"127.0.0.1", "Port":"1883",
+                      "Username":"", "Password":"", "Mode1":"", "Mode2":"milight/:device_id/:device_type/:group_id",
+                      "Mode3":"milight/states/:device_id/:device_type/:group_id", "Mode4":"milight/updates/:device_id/:device_type/:group_id",
+                      "Mode5":"", "Mode6":"Normal"}
+
+TYPENAMES = {"Switch":(0xf4, 0x49, 0), "Selector Switch":(0xf4, 0x3e, 18), "Dimmer":(0xf4, 0x49, 7), "Text":(0xf3, 0x13, 0), "Custom":(0xf3, 0x1f, 0)}
+
+# Binds fresh Devices/Parameters dictionaries to the plugin module, as the framework does
+def install(plugin, parameters=None):
+    global Devices, Parameters, heartbeat, debugging
+    Devices = dict()
+    Parameters = dict(DEFAULT_PARAMETERS)
+    if parameters:
+        Parameters.update(parameters)
+    counts.clear()
+    messages.clear()
+    del connections[:]
+    heartbeat = 10
+    debugging = 0
+    plugin.Devices = Devices
+    plugin.Parameters = Parameters
+
+def _log(kind, text):
+    counts[kind] += 1
+    messages.append((kind, text))
+
+def Log(text):
+    _log('Log', text)
+
+def Status(text):
+    _log('Status', text)
+
+def Error(text):
+    _log('Error', text)
+
+def Debug(text):
+    counts['Debug'] += 1
+    if debugging:
+        messages.append(('Debug', text))
+
+def Debugging(mask):
+    global debugging
+    debugging = mask
+
+def Heartbeat(interval):
+    global heartbeat
+    heartbeat = interval
+
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0, Description="", DeviceID=""):
+        if TypeName in TYPENAMES:
+            (Type, Subtype, Switchtype) = TYPENAMES[TypeName]
+        self.ID = 0
+        self.Name = Name
+        self.Unit = Unit
+        self.DeviceID = DeviceID
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = dict(Options) if Options else dict()
+        self.Used = int(Used)
+        self.Description = Description
+        self.nValue = 0
+        self.sValue = ""
+        self.Color = ""
+        self.LastLevel = 0
+        self.LastUpdate = ""
+        self.TimedOut = 0
+
+    def __str__(self):
+        return "Unit: " + str(self.Unit) + ", Name: '" + self.Name + "', nValue: " + str(self.nValue) + ", sValue: '" + self.sValue + "'"
+
+    def Create(self):
+        counts['Create'] += 1
+        if self.Unit in Devices or not 0 < self.Unit <= MAX_UNIT:
+            Error("Device creation failed, Unit " + str(self.Unit) + " in use or out of range")
+            return
+        self.ID = self.Unit
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=None, sValue=None, Image=None, SignalLevel=None, BatteryLevel=None, Options=None, TimedOut=None, Name=None,
+               TypeName=None, Type=None, Subtype=None, Switchtype=None, Used=None, Description=None, Color=None, SuppressTriggers=False):
+        counts['Update'] += 1
+        if nValue != None:
+            self.nValue = nValue
+        if sValue != None:
+            self.sValue = sValue
+            if sValue.isdigit():
+                self.LastLevel = int(sValue)
+        if Color != None:
+            # Domoticz stores color components as integers
+            try:
+                self.Color = json.dumps({k:int(v) for k, v in json.loads(Color).items()})
+            except (ValueError, TypeError, AttributeError):
+                self.Color = Color
+        for name, value in (("Image", Image), ("Options", Options), ("Name", Name), ("Type", Type), ("SubType", Subtype),
+                            ("SwitchType", Switchtype), ("Used", Used), ("Description", Description), ("TimedOut", TimedOut)):
+            if value != None:
+                setattr(self, name, value)
+
+    def Refresh(self):
+        pass
+
+    def Delete(self):
+        counts['Delete'] += 1
+        Devices.pop(self.Unit, None)
+
+
+class Connection:
+    def __init__(self, Name="", Transport="", Protocol="", Address="", Port="", Baud=0):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.Baud = Baud
+        self.connecting = False
+        self.connected = False
+        self.sent = []
+        connections.append(self)
+
+    def __str__(self):
+        return "Name: '" + self.Name + "', Address: '" + self.Address + "', Port: '" + str(self.Port) + "'"
+
+    def Connect(self):
+        counts['Connect'] += 1
+        self.connecting = True
+
+    def Listen(self):
+        pass
+
+    def Connecting(self):
+        return self.connecting
+
+    def Connected(self):
+        return self.connected
+
+    def Send(self, Message, Delay=0):
+        counts['Send'] += 1
+        self.sent.append(Message)
+
+    def Disconnect(self):
+        counts['Disconnect'] += 1
+        self.connecting = False
+        self.connected = False
+
+    # Not part of the framework: completes the connection as the framework would
+    def accept(self, plugin):
+        self.connecting = False
+        self.connected = True
+        plugin.onConnect(self, 0, "")
+        plugin.onMessage(self, {'Verb':'CONNACK', 'Status':0})
+        plugin.onMessage(self, {'Verb':'SUBACK', 'Topics':[]})
@@ -0,0 +1,215 @@
+#           Offline benchmarks for the plugin hot paths
+#
+"""Drives plugin.py against the Domoticz stand-in and reports throughput,
+per-call latency percentiles and allocations for the hot paths.
+
+    python3 tools/benchmark.py
+    python3 tools/benchmark.py --devices 10,100,1000 --messages 20000 --options '{"coalesceWindow":200}'
+    python3 tools/benchmark.py --devices 10 --workloads compute_hs_to_rgb,hs_to_rgb,hs_to_rgb_batch,rgb_to_hs,rgb_to_hs_batch
+    python3 tools/benchmark.py --workloads e2e_states,e2e_commands
+
+The e2e_ workloads run through the loopback broker: states published by a
+simulated hub reach the plugin through its MQTT client, and commands are
+published back to the hub.
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Domoticz
+import loopback
+import plugin
+
+DEVICE_TYPES = ['rgb_cct', 'fut089', 'cct', 'rgbw', 'rgb']
+BATCH_SIZE = 1000
+TABLE_WORKLOADS = ('hs_to_rgb', 'hs_to_rgb_batch') # Timed once their lookup tables are filled, as in a running plugin
+broker = None # Loopback broker of the e2e_ workloads
+hub = None # Its client standing in for the hub
+COMMANDS = [("On", 0, ""), ("Off", 0, ""), ("Set Level", 40, ""), ("Set Level", 80, ""), ("Bright Up", 0, ""),
+            ("Set Color", 60, '{"m":3,"r":255,"g":0,"b":64}'), ("Set Color", 60, '{"m":2,"t":128}'), ("Set White", 0, "")]
+
+# Returns (plugin module, Devices, list of device keys) with 'count' devices discovered
+def setup(count, options="", debugging="Normal", e2e=False):
+    global broker, hub
+    importlib.reload(plugin)
+    Domoticz.MAX_UNIT = plugin.MAX_UNIT = max(255, count)
+    broker = None
+    if e2e:
+        broker = loopback.Broker()
+        plugin.mqttTransport = broker.transport(plugin)
+    Domoticz.install(plugin, {"Mode5":options, "Mode6":debugging})
+    plugin.onStart()
+    if e2e:
+        broker.pump()
+        hub = broker.client(None)
+        hub.subscribe(Domoticz.Parameters["Mode2"].replace(":device_id", "+").replace(":device_type", "+").replace(":group_id", "+"))
+    else:
+        Domoticz.connections[-1].accept(plugin)
+    keys = []
+    for i in range(count):
+        key = ('0x%04X' % (i // 4 + 1), DEVICE_TYPES[(i // 4) % len(DEVICE_TYPES)], str(i % 4 + 1))
+        keys.append(key)
+        if e2e:
+            hub.publish(statesTopic(key), b'{"state":"ON","brightness":128}')
+            broker.pump()
+        else:
+            plugin._plugin.onMQTTPublish(statesTopic(key), b'{"state":"ON","brightness":128}')
+    flush()
+    return keys
+
+def statesTopic(key):
+    return Domoticz.Parameters["Mode3"].replace(":device_id", key[0]).replace(":device_type", key[1]).replace(":group_id", key[2])
+
+def updatesTopic(key):
+    return Domoticz.Parameters["Mode4"].replace(":device_id", key[0]).replace(":device_type", key[1]).replace(":group_id", key[2])
+
+def randomState(rnd):
+    message = {"state":rnd.choice(["ON", "OFF"]), "brightness":rnd.randrange(256)}
+    extra = rnd.randrange(3)
+    if extra == 0:
+        message.update({"bulb_mode":"color", "hue":rnd.randrange(360), "saturation":rnd.randrange(101)})
+    elif extra == 1:
+        message.update({"bulb_mode":"white", "color_temp":rnd.randrange(153, 371)})
+    return message
+
+# Flushes anything the plugin buffers, so every workload ends with the same device state
+def flush():
+    p = plugin._plugin
+    if p.inbound != None or any(hub.outbound != None for hub in p.hubs):
+        p.onHeartbeat()
+    while p.discovery:
+        p.onHeartbeat()
+    if broker != None:
+        broker.pump()
+
+def hubPublish(topic, payload):
+    hub.publish(topic, payload)
+    broker.pump()
+
+def commandRoundTrip(Unit, Command, Level, Color):
+    plugin._plugin.onCommand(Unit, Command, Level, Color)
+    broker.pump()
+
+# Returns list of zero-argument callables for one workload
+def workload(name, keys, count, mix, rnd):
+    p = plugin._plugin
+    calls = []
+    if name == 'onMQTTPublish':
+        for i in range(count):
+            key = rnd.choice(keys)
+            if rnd.random() < mix:
+                topic = updatesTopic((key[0], key[1], '0'))
+            else:
+                topic = statesTopic(key)
+            calls.append((p.onMQTTPublish, (topic, json.dumps(randomState(rnd)).encode())))
+    elif name == 'updateLightDevice':
+        for i in range(count):
+            calls.append((p.updateLightDevice, rnd.choice(keys) + (randomState(rnd),)))
+    elif name == 'setLightDevice':
+        for i in range(count):
+            calls.append((p.setLightDevice, rnd.choice(keys) + (randomState(rnd),)))
+    elif name == 'getDevices':
+        for i in range(count):
+            calls.append((p.getDevices, rnd.choice(keys)))
+    elif name == 'compute_hs_to_rgb' or name == 'hs_to_rgb':
+        fn = getattr(plugin, name)
+        for i in range(count):
+            calls.append((fn, (rnd.randrange(361), rnd.randrange(101))))
+    elif name == 'rgb_to_hs':
+        for i in range(count):
+            calls.append((plugin.rgb_to_hs, (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))))
+    elif name == 'hs_to_rgb_batch' or name == 'rgb_to_hs_batch':
+        # One call converts BATCH_SIZE values, calls/s is multiplied accordingly in the report
+        fn = getattr(plugin, name)
+        for i in range(max(1, count // BATCH_SIZE)):
+            if name == 'hs_to_rgb_batch':
+                values = [(rnd.randrange(361), rnd.randrange(101)) for j in range(BATCH_SIZE)]
+            else:
+                values = [(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for j in range(BATCH_SIZE)]
+            calls.append((fn, (values,)))
+    elif name == 'onCommand':
+        units = list(Domoticz.Devices)
+        for i in range(count):
+            calls.append((p.onCommand, (rnd.choice(units),) + rnd.choice(COMMANDS)))
+    elif name == 'e2e_states':
+        for i in range(count):
+            calls.append((hubPublish, (statesTopic(rnd.choice(keys)), json.dumps(randomState(rnd)).encode())))
+    elif name == 'e2e_commands':
+        units = list(Domoticz.Devices)
+        for i in range(count):
+            calls.append((commandRoundTrip, (rnd.choice(units),) + rnd.choice(COMMANDS)))
+    return calls
+
+def percentile(sortedValues, pct):
+    if not sortedValues:
+        return 0
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * pct / 100))]
+
+def run(name, devices, count, mix, options, seed):
+    keys = setup(devices, options, e2e=name.startswith('e2e_'))
+    calls = workload(name, keys, count, mix, random.Random(seed))
+    if name in TABLE_WORKLOADS:
+        for fn, args in calls:
+            fn(*args)
+    timer = time.perf_counter
+    latencies = []
+    start = timer()
+    for fn, args in calls:
+        t = timer()
+        fn(*args)
+        latencies.append(timer() - t)
+    flush()
+    elapsed = timer() - start
+    latencies.sort()
+    values = count
+    if name.endswith('_batch'):
+        values = len(calls) * BATCH_SIZE
+
+    # Separate pass, tracemalloc distorts timing
+    keys = setup(devices, options, e2e=name.startswith('e2e_'))
+    calls = workload(name, keys, count, mix, random.Random(seed))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for fn, args in calls:
+        fn(*args)
+    flush()
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return {"workload":name, "devices":devices, "calls":count, "per_sec":values / elapsed if elapsed > 0 else 0,
+            "p50_us":percentile(latencies, 50) * 1e6, "p90_us":percentile(latencies, 90) * 1e6, "p99_us":percentile(latencies, 99) * 1e6,
+            "peak_kb":peak / 1024.0, "retained_kb":retained / 1024.0, "updates":Domoticz.counts['Update'], "sends":Domoticz.counts['Send'],
+            "deliveries":broker.counts['deliver'] if broker != None else 0}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', default='10,100,1000', help="comma separated device counts")
+    parser.add_argument('--messages', type=int, default=5000, help="calls per workload")
+    parser.add_argument('--updates', type=float, default=0.1, help="fraction of onMQTTPublish messages sent to group 0 updates topics")
+    parser.add_argument('--workloads', default='onMQTTPublish,updateLightDevice,onCommand,getDevices,setLightDevice')
+    parser.add_argument('--options', default='', help="plugin options JSON (Mode5)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print results as JSON lines")
+    args = parser.parse_args()
+
+    if not args.json:
+        print("%-18s %7s %8s %10s %9s %9s %9s %9s %11s" % ("workload", "devices", "calls", "calls/s", "p50 us", "p90 us", "p99 us", "peak KB", "retained KB"))
+    for devices in [int(d) for d in args.devices.split(',')]:
+        for name in args.workloads.split(','):
+            result = run(name, devices, args.messages, args.updates, args.options, args.seed)
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print("%-18s %7d %8d %10.0f %9.1f %9.1f %9.1f %9.1f %11.1f" % (name, devices, result["calls"], result["per_sec"], result["p50_us"],
+                      result["p90_us"], result["p99_us"], result["peak_kb"], result["retained_kb"]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#           In-process MQTT broker stand-in
+#
+"""In-process MQTT broker for running plugin.py without a broker or Domoticz.
+
+The broker routes PUBLISH messages between plugin connections and local
+clients (e.g. a simulated hub), with '+'/'#' wildcard subscriptions and
+retained messages. Like the plugin framework, it delivers events from a
+queue: nothing reaches a client until pump() is called, so a plugin callback
+is never re-entered from within a publish.
+
+Usage:
+    import Domoticz, plugin, loopback
+    broker = loopback.Broker()
+    plugin.mqttTransport = broker.transport(plugin)
+    Domoticz.install(plugin, {})
+    plugin.onStart()
+    broker.pump()                   # CONNACK, SUBACK
+    hub = broker.client(lambda topic, payload: ...)
+    hub.subscribe("milight/+/+/+")
+    hub.publish("milight/states/0x1/rgb_cct/1", b'{"state":"ON"}')
+    broker.pump()                   # plugin.onMessage
+"""
+from collections import Counter, deque
+
+# Returns True if an MQTT topic filter (with '+' and '#' wildcards) matches topic
+def topicMatches(topicFilter, topic):
+    filterParts = topicFilter.split('/')
+    topicParts = topic.split('/')
+    for i, part in enumerate(filterParts):
+        if part == '#':
+            return True
+        if i >= len(topicParts):
+            return False
+        if part != '+' and part != topicParts[i]:
+            return False
+    return len(filterParts) == len(topicParts)
+
+
+class Broker:
+    """Routes messages between the subscribers of one in-process broker."""
+    def __init__(self):
+        self.subscribers = dict() # Key=subscriber, Value=set of topic filters
+        self.retained = dict() # Key=topic, Value=payload bytes
+        self.events = deque() # Callables delivering one event each
+        self.counts = Counter()
+        self.onDelivered = None # Optional callback(subscriber, topic, stamp) after each delivered message
+
+    # Returns a transport for plugin.mqttTransport, delivering events to the plugin module's callbacks
+    def transport(self, plugin):
+        def connect(name, address, port):
+            return LoopbackConnection(self, plugin, name, address, port)
+        return connect
+
+    # Returns a local client, callback(topic, payload) is called for every message it receives
+    def client(self, callback):
+        return Client(self, callback)
+
+    def subscribe(self, subscriber, topicFilters):
+        self.subscribers.setdefault(subscriber, set()).update(topicFilters)
+        for topic, payload in self.retained.items():
+            if any(topicMatches(f, topic) for f in topicFilters):
+                self.post(subscriber, topic, payload)
+
+    def unsubscribe(self, subscriber, topicFilters=None):
+        if topicFilters == None:
+            self.subscribers.pop(subscriber, None)
+        elif subscriber in self.subscribers:
+            self.subscribers[subscriber].difference_update(topicFilters)
+
+    # 'stamp' is any value handed to onDelivered, e.g. the time the message was due
+    def publish(self, topic, payload, retain=False, stamp=None):
+        payload = bytes(payload)
+        self.counts['publish'] += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for subscriber, topicFilters in self.subscribers.items():
+            if any(topicMatches(f, topic) for f in topicFilters):
+                self.post(subscriber, topic, payload, stamp)
+
+    def post(self, subscriber, topic, payload, stamp=None):
+        self.counts['deliver'] += 1
+        self.events.append(lambda: self.deliver(subscriber, topic, payload, stamp))
+
+    def deliver(self, subscriber, topic, payload, stamp):
+        subscriber.deliver(topic, payload)
+        if self.onDelivered != None:
+            self.onDelivered(subscriber, topic, stamp)
+
+    # Delivers queued events, including those queued while delivering, returns the number delivered
+    def pump(self, limit=None):
+        n = 0
+        while self.events and (limit == None or n < limit):
+            self.events.popleft()()
+            n += 1
+        return n
+
+
+class Client:
+    """A local broker client, such as a simulated hub."""
+    def __init__(self, broker, callback):
+        self.broker = broker
+        self.callback = callback
+
+    def subscribe(self, *topicFilters):
+        self.broker.subscribe(self, topicFilters)
+
+    def unsubscribe(self, *topicFilters):
+        self.broker.unsubscribe(self, topicFilters)
+
+    def publish(self, topic, payload, retain=False, stamp=None):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.broker.publish(topic, payload, retain, stamp)
+
+    def deliver(self, topic, payload):
+        if self.callback != None:
+            self.callback(topic, payload)
+
+
+class LoopbackConnection:
+    """Plays the part of a framework MQTT connection on a loopback broker."""
+    def __init__(self, broker, plugin, Name, Address, Port):
+        self.broker = broker
+        self.plugin = plugin
+        self.Name = Name
+        self.Address = Address
+        self.Port = Port
+        self.connecting = False
+        self.connected = False
+        self.sent = Counter() # Key=verb
+
+    def __str__(self):
+        return "Name: '" + self.Name + "', Address: '" + self.Address + "', Port: '" + str(self.Port) + "' (loopback)"
+
+    def Connect(self):
+        self.connecting = True
+        self.broker.events.append(self.accept)
+
+    def accept(self):
+        if not self.connecting:
+            return
+        self.connecting = False
+        self.connected = True
+        self.plugin.onConnect(self, 0, "")
+
+    def Connecting(self):
+        return self.connecting
+
+    def Connected(self):
+        return self.connected
+
+    def Send(self, Message, Delay=0):
+        verb = Message['Verb']
+        self.sent[verb] += 1
+        if not self.connected:
+            return
+        if verb == 'CONNECT':
+            self.reply({'Verb': 'CONNACK', 'Status': 0})
+        elif verb == 'SUBSCRIBE':
+            self.reply({'Verb': 'SUBACK', 'Topics': Message['Topics']})
+            self.broker.subscribe(self, [t['Topic'] for t in Message['Topics']])
+        elif verb == 'UNSUBSCRIBE':
+            self.broker.unsubscribe(self, Message['Topics'])
+            self.reply({'Verb': 'UNSUBACK'})
+        elif verb == 'PUBLISH':
+            self.broker.publish(Message['Topic'], Message['Payload'], Message.get('Retain', 0))
+        elif verb == 'PING':
+            self.reply({'Verb': 'PINGRESP'})
+        elif verb == 'DISCONNECT':
+            self.broker.unsubscribe(self)
+
+    def Disconnect(self):
+        self.broker.unsubscribe(self)
+        was = self.connected or self.connecting
+        self.connecting = False
+        self.connected = False
+        if was:
+            self.broker.events.append(lambda: self.plugin.onDisconnect(self))
+
+    # Not part of the framework: drops the connection as if the broker went away
+    def drop(self):
+        self.Disconnect()
+
+    def reply(self, Data):
+        self.broker.events.append(lambda: self.plugin.onMessage(self, Data))
+
+    def deliver(self, topic, payload):
+        if self.connected:
+            self.plugin.onMessage(self, {'Verb': 'PUBLISH', 'Topic': topic, 'Payload': payload, 'QoS': 0})
@@ -0,0 +1,99 @@
+#           Replay of captured MQTT traffic
+#
+"""Feeds a capture written by the "captureFile" option back through the plugin,
+running against the Domoticz stand-in.
+
+    python3 tools/replay.py capture.bin                 # real time
+    python3 tools/replay.py capture.bin --speed 10      # 10x real time
+    python3 tools/replay.py capture.bin --speed 0       # as fast as possible
+    python3 tools/replay.py capture.bin --speed 0 --profile replay.pstats
+
+Each message goes to the connection of the hub it was captured from, so a
+multi-hub capture needs the same "hubs" in --options. Messages of the primary
+hub, of hubs not configured and of captures without hub names go to the
+primary hub's connection.
+"""
+import argparse
+import cProfile
+import os
+import pstats
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Domoticz
+import plugin
+from benchmark import percentile
+
+def replay(filename, speed, options, parameters):
+    # A fresh plugin folder, so no snapshot or other file of an earlier run is picked up
+    with tempfile.TemporaryDirectory() as home:
+        Domoticz.install(plugin, dict(parameters, HomeFolder=home + os.sep))
+        Domoticz.Parameters["Mode5"] = options
+        return run(filename, speed)
+
+def run(filename, speed):
+    plugin.onStart()
+    conns = dict()
+    for conn in list(Domoticz.connections):
+        conn.accept(plugin)
+        conns.setdefault(conn.Name, conn)
+    primary = Domoticz.connections[0]
+
+    timer = time.perf_counter
+    latencies = []
+    maxLag = 0
+    firstTimestamp = None
+    nextHeartbeat = 0
+    start = timer()
+    for (timestamp, hub, topic, payload) in plugin.MqttCapture.read(filename):
+        if firstTimestamp == None:
+            firstTimestamp = timestamp
+        offset = timestamp - firstTimestamp
+        # Heartbeats follow capture time
+        while offset >= nextHeartbeat:
+            plugin.onHeartbeat()
+            nextHeartbeat += Domoticz.heartbeat
+        if speed > 0:
+            due = start + offset / speed
+            now = timer()
+            if due > now:
+                time.sleep(due - now)
+            else:
+                maxLag = max(maxLag, now - due)
+        t = timer()
+        plugin.onMessage(conns.get(hub, primary), {'Verb':'PUBLISH', 'Topic':topic, 'Payload':payload})
+        latencies.append(timer() - t)
+    plugin.onHeartbeat()
+    plugin.onStop()
+    elapsed = timer() - start
+    latencies.sort()
+    return {"messages":len(latencies), "elapsed":elapsed, "per_sec":len(latencies) / elapsed if elapsed > 0 else 0,
+            "max_lag":maxLag, "p50_us":percentile(latencies, 50) * 1e6, "p99_us":percentile(latencies, 99) * 1e6,
+            "max_us":(latencies[-1] if latencies else 0) * 1e6, "devices":len(Domoticz.Devices), "counts":dict(Domoticz.counts)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture', help="capture file")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed factor, 0 = as fast as possible")
+    parser.add_argument('--options', default='', help="plugin options JSON (Mode5)")
+    parser.add_argument('--states', default=Domoticz.DEFAULT_PARAMETERS["Mode3"], help="mqtt_states_topic_pattern")
+    parser.add_argument('--updates', default=Domoticz.DEFAULT_PARAMETERS["Mode4"], help="mqtt_updates_topic_pattern")
+    parser.add_argument('--profile', help="write cProfile statistics to this file")
+    args = parser.parse_args()
+
+    parameters = {"Mode3":args.states, "Mode4":args.updates}
+    if args.profile:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(replay, args.capture, args.speed, args.options, parameters)
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    else:
+        result = replay(args.capture, args.speed, args.options, parameters)
+    for k, v in result.items():
+        print("%-10s %s" % (k, v))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+#           Synthetic ESP8266 Milight hub and load generator
+#
+"""Runs plugin.py against a simulated esp8266_milight_hub on the loopback broker,
+at a given rate of state messages, and reports how far the plugin falls behind.
+
+The simulated hub owns N remotes of mixed types. Its users move brightness
+sliders (bursts of states), press on/off, press group 0 (an updates message
+plus the state of every group) and change colour or white temperature. It
+answers every commands message with the state echo of the groups addressed.
+Dashboard commands can be generated too, their round trip ends when the echo
+has been handled by the plugin.
+
+    python3 tools/simulator.py --remotes 50 --rate 200 --duration 10
+    python3 tools/simulator.py --remotes 50 --rate 2000 --duration 10 --commands 20 --options '{"coalesceWindow":200}'
+
+Latency is measured from the moment a message was due to the moment the
+plugin returned from handling it, so it includes the time spent waiting
+behind earlier messages. 'max_backlog' is the longest queue of undelivered
+events, 'drain_s' how long the plugin needed after the last message was due.
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Domoticz
+import loopback
+import plugin
+from benchmark import percentile
+
+DEVICE_TYPES = ['rgb_cct', 'fut089', 'cct', 'rgbw', 'rgb']
+SLIDER_STEP = 0.05 # Seconds between states while a slider moves
+GROUP_PRESS = 0.02 # Seconds between the states of the groups after a group 0 press
+
+class VirtualHub:
+    """Remotes, bulb states and topic patterns of one simulated hub."""
+    def __init__(self, broker, parameters, remotes, rnd):
+        self.broker = broker
+        self.commandsFormat = parameters["Mode2"]
+        self.statesFormat = parameters["Mode3"]
+        self.updatesFormat = parameters["Mode4"]
+        self.rnd = rnd
+        self.commandMatcher = plugin.TopicMatcher([(plugin.TOPIC_COMMANDS, self.commandsFormat)])
+        self.remotes = []
+        self.bulbs = dict() # Key=(device_id, device_type, group_id), Value=state dict as published
+        for i in range(remotes):
+            device_type = DEVICE_TYPES[i % len(DEVICE_TYPES)]
+            device_id = '0x%04X' % (i + 1)
+            self.remotes.append((device_id, device_type))
+            for group in range(1, plugin.GROUP_COUNTS.get(device_type, plugin.DEFAULT_GROUP_COUNT) + 1):
+                self.bulbs[(device_id, device_type, str(group))] = {"state":"ON", "brightness":128, "bulb_mode":"white", "color_temp":250}
+        self.commandStamps = dict() # Key=commands topic, Value=time the last dashboard command for it was issued
+        self.client = broker.client(self.onCommandMessage)
+        self.client.subscribe(self.topic(self.commandsFormat, "+", "+", "+"))
+
+    def topic(self, pattern, device_id, device_type, group_id):
+        return pattern.replace(":device_id", device_id).replace(":hex_device_id", device_id).replace(":device_type", device_type).replace(":group_id", group_id)
+
+    def groups(self, device_id, device_type):
+        return [str(g) for g in range(1, plugin.GROUP_COUNTS.get(device_type, plugin.DEFAULT_GROUP_COUNT) + 1)]
+
+    def publishState(self, key, stamp):
+        self.client.publish(self.topic(self.statesFormat, *key), json.dumps(self.bulbs[key]), stamp=stamp)
+
+    def publishUpdate(self, device_id, device_type, group_id, update, stamp):
+        self.client.publish(self.topic(self.updatesFormat, device_id, device_type, group_id), json.dumps(update), stamp=stamp)
+
+    # Returns list of (offset, function, messages published) making up one user interaction starting at offset 0
+    def interaction(self):
+        rnd = self.rnd
+        (device_id, device_type) = rnd.choice(self.remotes)
+        group = rnd.choice(self.groups(device_id, device_type))
+        key = (device_id, device_type, group)
+        steps = []
+        x = rnd.random()
+        if x < 0.5:
+            # Slider: a burst of brightness states towards a target
+            target = rnd.randrange(256)
+            start = self.bulbs[key]["brightness"]
+            n = rnd.randrange(5, 20)
+            for i in range(1, n + 1):
+                steps.append((i * SLIDER_STEP, self.setter(key, {"state":"ON", "brightness":start + (target - start) * i // n}, update=True), 2))
+        elif x < 0.7:
+            steps.append((0, self.setter(key, {"state":rnd.choice(["ON", "OFF"])}, update=True), 2))
+        elif x < 0.85:
+            # Group 0 press: one updates message, then the state of every group
+            update = {"state":rnd.choice(["ON", "OFF"])}
+            steps.append((0, lambda stamp: self.publishUpdate(device_id, device_type, '0', update, stamp), 1))
+            for i, g in enumerate(self.groups(device_id, device_type)):
+                steps.append(((i + 1) * GROUP_PRESS, self.setter((device_id, device_type, g), update), 1))
+        elif device_type in ('rgb_cct', 'fut089', 'rgbw', 'rgb') and rnd.random() < 0.5:
+            steps.append((0, self.setter(key, {"state":"ON", "bulb_mode":"color", "hue":rnd.randrange(360), "saturation":rnd.randrange(101)}, update=True), 2))
+        else:
+            steps.append((0, self.setter(key, {"state":"ON", "bulb_mode":"white", "color_temp":rnd.randrange(plugin.MIRED_MIN, plugin.MIRED_MAX + 1)}, update=True), 2))
+        return steps
+
+    # Returns function(stamp) that changes a bulb and publishes its state, preceded by an updates message like a remote press
+    def setter(self, key, fields, update=False):
+        def apply(stamp):
+            self.bulbs[key].update(fields)
+            if update:
+                self.publishUpdate(key[0], key[1], key[2], fields, stamp)
+            self.publishState(key, stamp)
+        return apply
+
+    # Answers a commands message with the state echo of the groups it addresses
+    def onCommandMessage(self, topic, payload):
+        match = self.commandMatcher.match(topic)
+        if match == None:
+            return
+        (kind, device_id, device_type, group_id) = match
+        stamp = self.commandStamps.pop(topic, None)
+        try:
+            command = json.loads(payload.decode('utf-8'))
+        except ValueError:
+            return
+        fields = dict()
+        if 'status' in command:
+            fields["state"] = command['status']
+        if 'level' in command:
+            fields["brightness"] = int(command['level'] * 255 / 100)
+        if command.get('command') == 'set_white' or 'temperature' in command:
+            fields["bulb_mode"] = "white"
+        if 'temperature' in command:
+            fields["color_temp"] = int(plugin.MIRED_MIN + command['temperature'] * (plugin.MIRED_MAX - plugin.MIRED_MIN) / 100)
+        if 'color' in command:
+            c = command['color']
+            (fields["hue"], fields["saturation"]) = plugin.rgb_to_hs(c['r'], c['g'], c['b'])
+            fields["bulb_mode"] = "color"
+        groups = self.groups(device_id, device_type) if group_id == '0' else [group_id]
+        for g in groups:
+            key = (device_id, device_type, g)
+            if key in self.bulbs:
+                self.bulbs[key].update(fields)
+                self.publishState(key, ('command', stamp) if stamp != None else None)
+
+
+def simulate(remotes, rate, duration, commandRate=0, options="", parameters=None, seed=1):
+    rnd = random.Random(seed)
+    broker = loopback.Broker()
+    plugin.mqttTransport = broker.transport(plugin)
+    Domoticz.install(plugin, parameters or {})
+    Domoticz.Parameters["Mode5"] = options
+    plugin.onStart()
+    broker.pump()
+    hub = VirtualHub(broker, Domoticz.Parameters, remotes, rnd)
+
+    # Discovery, not measured
+    for key in hub.bulbs:
+        hub.publishState(key, None)
+    broker.pump()
+    # States merged by the coalescer reach discovery once flushed
+    if plugin._plugin.inbound != None:
+        plugin._plugin.flushInbound()
+    while plugin._plugin.discovery:
+        plugin.onHeartbeat()
+        broker.pump()
+
+    # Schedule of (offset, sequence, function(stamp)), interactions spaced to average 'rate' messages per second
+    schedule = []
+    seq = 0
+    t = 0.0
+    while t < duration:
+        steps = hub.interaction()
+        for offset, fn, messages in steps:
+            heapq.heappush(schedule, (t + offset, seq, fn))
+            seq += 1
+        t += sum(rnd.expovariate(rate) for step in steps for m in range(step[2]))
+    if commandRate > 0:
+        units = [u for u, d in Domoticz.Devices.items() if 'device_id' in d.Options]
+        commands = [("On", 0, ""), ("Off", 0, ""), ("Set Level", 30, ""), ("Set Level", 90, ""), ("Set Color", 60, '{"m":3,"r":255,"g":0,"b":64}')]
+        t = rnd.expovariate(commandRate)
+        while t < duration and units:
+            heapq.heappush(schedule, (t, seq, commandSender(hub, rnd.choice(units), rnd.choice(commands))))
+            seq += 1
+            t += rnd.expovariate(commandRate)
+
+    lastDue = max(entry[0] for entry in schedule) if schedule else 0
+    latencies = []
+    roundTrips = []
+    stats = {"messages":0, "max_backlog":0}
+    timer = time.perf_counter
+    def delivered(subscriber, topic, stamp):
+        if stamp == None or subscriber is hub.client:
+            return
+        if type(stamp) == tuple:
+            roundTrips.append(timer() - stamp[1])
+        else:
+            latencies.append(timer() - stamp)
+        stats["messages"] += 1
+    broker.onDelivered = delivered
+
+    start = timer()
+    nextHeartbeat = start + Domoticz.heartbeat
+    while schedule or broker.events:
+        now = timer()
+        while schedule and start + schedule[0][0] <= now:
+            (offset, n, fn) = heapq.heappop(schedule)
+            fn(start + offset)
+        if now >= nextHeartbeat:
+            plugin.onHeartbeat()
+            nextHeartbeat = now + Domoticz.heartbeat
+        stats["max_backlog"] = max(stats["max_backlog"], len(broker.events))
+        if broker.events:
+            broker.pump(1)
+        elif schedule:
+            time.sleep(max(0, min(start + schedule[0][0], nextHeartbeat) - timer()))
+    end = timer()
+    plugin.onHeartbeat()
+    broker.pump()
+    plugin.onStop()
+
+    latencies.sort()
+    roundTrips.sort()
+    elapsed = end - start
+    return {"remotes":remotes, "devices":len(Domoticz.Devices), "rate":rate, "messages":stats["messages"],
+            "per_sec":stats["messages"] / elapsed if elapsed > 0 else 0, "drain_s":max(0, elapsed - lastDue),
+            "max_backlog":stats["max_backlog"], "p50_ms":percentile(latencies, 50) * 1e3, "p99_ms":percentile(latencies, 99) * 1e3,
+            "max_ms":(latencies[-1] if latencies else 0) * 1e3, "commands":len(roundTrips),
+            "command_p50_ms":percentile(roundTrips, 50) * 1e3, "command_p99_ms":percentile(roundTrips, 99) * 1e3,
+            "updates":Domoticz.counts['Update'], "metrics":plugin._plugin.metrics.summary()}
+
+# Returns function(stamp) issuing a dashboard command, its state echo is timed from 'stamp'
+def commandSender(hub, Unit, command):
+    def send(stamp):
+        device = Domoticz.Devices.get(Unit)
+        if device == None:
+            return
+        topic = hub.topic(hub.commandsFormat, device.Options['device_id'], device.Options['device_type'], device.Options['group_id'])
+        hub.commandStamps[topic] = stamp
+        plugin.onCommand(Unit, *command)
+    return send
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--remotes', type=int, default=20, help="virtual remotes, types rgb_cct, fut089, cct, rgbw and rgb in turn")
+    parser.add_argument('--rate', type=float, default=100, help="average hub messages per second")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of generated traffic")
+    parser.add_argument('--commands', type=float, default=0, help="dashboard commands per second")
+    parser.add_argument('--options', default='{"metricsReport":"none", "snapshotInterval":0}', help="plugin options JSON (Mode5)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print the result as JSON")
+    args = parser.parse_args()
+
+    result = simulate(args.remotes, args.rate, args.duration, args.commands, args.options, seed=args.seed)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for k, v in result.items():
+            print("%-15s %s" % (k, round(v, 3) if type(v) == float else v))
+
+if __name__ == "__main__":
+    main()